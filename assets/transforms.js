@@ -0,0 +1,91 @@
+/* Graphs drawn in the browser in clientside mode (COVID_CLIENTSIDE=1) from the
+   Series store, the same figures update_graphs sends from the server: the
+   CumulIncr view, the DateChoice window, the Log10 scale and the forward
+   looking moving average are all applied here. */
+
+// Day number of a DateChoice bound. A start later than midnight begins on the
+// next day, like day_number on the server.
+function covidDay(date, ceil) {
+    var day = Math.floor(Date.parse(date.slice(0, 10)) / 86400000);
+    if (ceil && /[1-9]/.test(date.slice(10))) {
+        day += 1;
+    }
+    return day;
+}
+
+function covidFinite(value) {
+    return value !== null && isFinite(value);
+}
+
+// n row moving average over the rows that follow, null where the window runs
+// past the end or holds a missing value
+function covidAverage(values, n) {
+    var average = new Array(values.length).fill(null);
+    var total = 0, bad = 0;
+    for (var i = values.length - 1; i >= 0; i--) {
+        if (covidFinite(values[i])) {
+            total += values[i];
+        } else {
+            bad += 1;
+        }
+        if (i + n < values.length) {
+            if (covidFinite(values[i + n])) {
+                total -= values[i + n];
+            } else {
+                bad -= 1;
+            }
+        }
+        if (i + n <= values.length && bad === 0) {
+            average[i] = total / n;
+        }
+    }
+    return average;
+}
+
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    covid: {
+        graphs: function(series, cumulincr, scale, movingaverage, start_date, end_date, settings) {
+            var states = series ? series.states : [];
+            var n = settings.windows[movingaverage];
+            var first = start_date ? covidDay(start_date, true) : -Infinity;
+            var last = end_date ? covidDay(end_date, false) : Infinity;
+
+            // Rows of each jurisdiction within the date window
+            var ranges = states.map(function(state) {
+                var dates = series.series[state].dates;
+                var start = 0, stop = dates.length;
+                while (start < stop && covidDay(dates[start], false) < first) {
+                    start += 1;
+                }
+                while (stop > start && covidDay(dates[stop - 1], false) > last) {
+                    stop -= 1;
+                }
+                return [start, stop];
+            });
+
+            return settings.metrics.map(function(metric) {
+                var traces = states.map(function(state, i) {
+                    var item = series.series[state];
+                    var values = item[cumulincr][metric].slice(ranges[i][0], ranges[i][1]);
+                    if (scale === 'Log10') {
+                        values = values.map(function(value) {
+                            return value === null ? null : Math.log10(value);
+                        });
+                    }
+                    if (n) {
+                        values = covidAverage(values, n);
+                    }
+                    return {
+                        'x': item.dates.slice(ranges[i][0], ranges[i][1]),
+                        'y': values.map(function(value) {
+                            return covidFinite(value) ? value : null;
+                        }),
+                        'name': state
+                    };
+                });
+                var layout = Object.assign({}, settings.layouts[scale], {'title': settings.titles[metric][cumulincr]});
+                return {'data': traces, 'layout': layout};
+            });
+        }
+    }
+});
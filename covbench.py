@@ -0,0 +1,319 @@
+import argparse
+import itertools
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+
+# Benchmarks of the data load and the figure callbacks on synthetic data, so
+# performance work can be measured offline without the live sources.
+#
+#   python covbench.py generate DIR --countries 200 --states 56 --days 365
+#   python covbench.py run DIR --out results.json
+#   python covbench.py compare before.json after.json
+#
+# generate writes OWID and covidtracking shaped CSVs and the population files
+# for them into DIR, run loads DIR in place of the live sources and writes the
+# timings as JSON, compare prints the change between two runs. Every graph
+# case also records the peak memory its callback allocated, which should stay
+# about the size of the figures it returns.
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+
+''' SYNTHETIC DATA '''
+# Jurisdiction names: the ones of the population files, then made up ones
+def names(real, count, pattern):
+    return list(real[:count]) + [pattern % i for i in range(max(0, count - len(real)))]
+
+
+# Running totals of the daily values, restarting at every jurisdiction
+def totals(daily, codes):
+    return pd.Series(daily).groupby(codes).cumsum().values
+
+
+def generate(folder, countries=200, states=56, days=365, seed=0):
+    rng = np.random.RandomState(seed)
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    dates = pd.date_range('2020-01-01', periods=days)
+
+    # World: each country starts reporting within the first third of the
+    # period, with blanks in the deaths and tests for the forward fill. Two US
+    # territories are added to be dropped like in the real file.
+    worldpop = pd.read_csv(os.path.join(here, 'worldpopulation.csv'))
+    countrynames = names(worldpop['states'].tolist(), countries, 'Country %04d')
+    population = np.concatenate([worldpop['population'].values[:countries]
+                                 , rng.randint(10**5, 10**8, size=max(0, countries - len(worldpop)))])
+    locations = countrynames + ['Guam', 'Puerto Rico']
+    starts = rng.randint(0, days//3 + 1, size=len(locations))
+    lengths = days - starts
+    codes = np.repeat(np.arange(len(locations)), lengths)
+    step = np.arange(len(codes)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    pop = np.concatenate([population, [10**5, 3*10**6]])[codes].astype(float)
+    newcases = rng.poisson(50 + step).astype(float)
+    newdeaths = rng.poisson(2 + step//10).astype(float)
+    newtests = rng.poisson(500 + 5*step).astype(float)
+    cases = totals(newcases, codes)
+    deaths = totals(newdeaths, codes)
+    tests = totals(newtests, codes)
+    deaths[rng.rand(len(codes)) < 0.1] = np.nan
+    missing = rng.rand(len(codes)) < 0.2
+    tests[missing] = np.nan
+    newtests[missing] = np.nan
+    world = pd.DataFrame({'iso_code': np.array([n[:3].upper() for n in locations])[codes]
+                          , 'continent': 'X'
+                          , 'location': np.array(locations)[codes]
+                          , 'date': np.asarray(dates.strftime('%Y-%m-%d'))[np.repeat(starts, lengths) + step]
+                          , 'total_cases': cases, 'new_cases': newcases
+                          , 'total_deaths': deaths, 'new_deaths': newdeaths
+                          , 'total_cases_per_million': (cases/pop*10**6).round(3)
+                          , 'new_cases_per_million': (newcases/pop*10**6).round(3)
+                          , 'total_deaths_per_million': (deaths/pop*10**6).round(3)
+                          , 'new_deaths_per_million': (newdeaths/pop*10**6).round(3)
+                          , 'total_tests': tests, 'new_tests': newtests
+                          , 'total_tests_per_thousand': (tests/pop*1000).round(3)
+                          , 'new_tests_per_thousand': (newtests/pop*1000).round(3)
+                          , 'tests_units': np.where(missing, None, 'tests performed')
+                          , 'stringency_index': 50.})
+    world.to_csv(os.path.join(folder, 'owid-covid-data.csv'), index=False)
+    pd.DataFrame({'states': countrynames, 'population': population}).to_csv(os.path.join(folder, 'worldpopulation.csv')
+                                                                             , index=False)
+
+    # US: states report from the second month on, newest day first like the
+    # covidtracking files, California without hospitalizations
+    uspop = pd.read_csv(os.path.join(here, 'uspopulation.csv'))
+    statenames = names([s for s in uspop['states'] if s != 'US'], states, 'S%03d')
+    usdates = dates[min(30, days - 1):][::-1]
+    ndays = len(usdates)
+    codes = np.tile(np.arange(states), ndays)
+    step = np.repeat(np.arange(ndays)[::-1], states)
+    daily = {'positive': rng.poisson(100 + step), 'negative': rng.poisson(900 + 5*step)
+             , 'hospitalized': rng.poisson(10 + step//5), 'death': rng.poisson(3 + step//10)}
+    st = pd.DataFrame({'date': np.repeat(np.asarray(usdates.strftime('%Y%m%d')).astype(int), states)
+                       , 'state': np.array(statenames)[codes]})
+    order = np.lexsort((step, codes))
+    for c, values in daily.items():
+        # Totals run forward in time, the rows are newest first
+        running = np.empty(len(values))
+        running[order] = totals(values[order], codes[order])
+        st[c] = running
+        st[c + 'Increase'] = values
+    st.loc[st['state'] == 'CA', 'hospitalized'] = np.nan
+    st['total'] = st['positive'] + st['negative']
+    st['totalTestResults'] = st['total']
+    st['totalTestResultsIncrease'] = st['positiveIncrease'] + st['negativeIncrease']
+    st['fips'] = codes + 1
+    st['dateChecked'] = np.repeat(np.asarray(usdates.strftime('%Y-%m-%dT20:00:00Z')), states)
+    st.to_csv(os.path.join(folder, 'states-daily.csv'), index=False)
+
+    us = st.drop(columns=['state', 'fips', 'dateChecked']).groupby('date', sort=False).sum()
+    us['states'] = states
+    us['dateChecked'] = np.asarray(usdates.strftime('%Y-%m-%dT20:00:00Z'))
+    us.reset_index().to_csv(os.path.join(folder, 'us-daily.csv'), index=False)
+
+    pd.DataFrame({'states': statenames, 'population2019': rng.randint(5*10**5, 4*10**7, size=states)
+                  , 'population2010': rng.randint(5*10**5, 4*10**7, size=states)}).to_csv(
+                      os.path.join(folder, 'uspopulation.csv'), index=False)
+
+
+''' BENCHMARKS '''
+def milliseconds(seconds):
+    return round(seconds*1000, 3)
+
+
+# Minimum and median of repeated calls, with the last result
+def measure(f, repeat):
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        result = f()
+        times.append(time.perf_counter() - start)
+    return {'min_ms': milliseconds(min(times)), 'median_ms': milliseconds(float(np.median(times)))}, result
+
+
+# Peak memory allocated during a call in KB, numpy reports its array buffers
+# to tracemalloc so they are counted with the Python objects
+def allocation(f):
+    tracemalloc.start()
+    try:
+        f()
+        return round(tracemalloc.get_traced_memory()[1]/1024., 1)
+    finally:
+        tracemalloc.stop()
+
+
+# Seconds spent in each data load step from the ETL timings
+def stage_seconds(histogram):
+    return dict((values[0], series[1]) for values, series in histogram.series.items())
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=here
+                                       , stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(folder, repeat=5, quick=False):
+    # Read the generated files, no refresher and no snapshot files
+    os.environ['COVID_SOURCE_DIR'] = folder
+    os.environ['COVID_OFFLINE'] = '1'
+    os.environ['COVID_SNAPSHOT_DIR'] = ''
+    sys.path.insert(0, here)
+    import plotly
+    import covdata
+    import covsearch
+    import covtiming
+    import covid19
+
+    results = {'meta': {'folder': os.path.abspath(folder), 'commit': git_commit(), 'created': time.time()
+                        , 'python': platform.python_version(), 'numpy': np.__version__, 'pandas': pd.__version__
+                        , 'repeat': repeat}}
+
+    # Data load, with its steps, and the snapshot files
+    before = stage_seconds(covtiming.etltimes)
+    start = time.perf_counter()
+    snapshot = covdata.load_snapshot(covid19.metrics)
+    pipeline = {'full_load_ms': milliseconds(time.perf_counter() - start)}
+    after = stage_seconds(covtiming.etltimes)
+    pipeline['stages_ms'] = dict((k, milliseconds(v - before.get(k, 0.))) for k, v in sorted(after.items()))
+    snapshotfolder = tempfile.mkdtemp(prefix='covbench')
+    try:
+        pipeline['save'], _ = measure(lambda: covdata.save_snapshot(snapshot, snapshotfolder), 1)
+        pipeline['read'], _ = measure(lambda: covdata.read_snapshot(snapshotfolder), repeat)
+    finally:
+        shutil.rmtree(snapshotfolder, ignore_errors=True)
+    store = snapshot.store
+    results['data'] = {'jurisdictions': len(store), 'rows': len(store.days)}
+    results['pipeline'] = pipeline
+    covid19.data.snapshot = snapshot
+
+    # Scope options, with nothing typed, and searches of typed names: a prefix,
+    # a word inside names, a code and a typo. The searches go to the index,
+    # past the cache of its options.
+    set_scope_option = covid19.set_scope_option.__wrapped__
+    results['scopes'] = dict((scope, measure(lambda: set_scope_option(scope, '', None, []), repeat)[0])
+                             for scope in covid19.scopes)
+    search = {}
+    search['index'], index = measure(lambda: covsearch.SearchIndex(snapshot.all_options, snapshot.isocodes), 1)
+    for query in ['a', 'new', 'york', 'usa', 'germny']:
+        search[query], _ = measure(lambda: index.search('All', query), repeat)
+    results['search'] = search
+
+    # Graphs across the inputs, timed with the JSON encoding Dash does
+    labels = store.keys()
+    last = str(store.dates(slice(int(np.argmax(store.days)), int(np.argmax(store.days)) + 1))[0])
+    selections = [1, 5, 20] if not quick else [1, 5]
+    ranges = {'all': (None, None)
+              , 'last90': (str(pd.Timestamp(last) - pd.Timedelta(days=89))[:10], last)
+              , 'last30': (str(pd.Timestamp(last) - pd.Timedelta(days=29))[:10], last)}
+    cumulincrs = ['Cumulative', 'Incremental', 'Rate Per Million', 'Other Rates'] if not quick else ['Cumulative', 'Other Rates']
+    averages = ['None'] + sorted(covid19.windows, key=covid19.windows.get)
+    update_graphs = covid19.update_graphs.__wrapped__
+    graphs = []
+    for count, (name, (start_date, end_date)), cumulincr, scale, movingaverage in itertools.product(
+            selections, sorted(ranges.items()), cumulincrs, ['Raw', 'Log10'], averages):
+        statesel = labels[::max(1, len(labels)//count)][:count]
+        def call():
+            return json.dumps({'response': update_graphs(statesel, cumulincr, scale, movingaverage
+                                                         , start_date, end_date, None)}
+                              , cls=plotly.utils.PlotlyJSONEncoder)
+        timing, body = measure(call, repeat)
+        timing['alloc_peak_kb'] = allocation(lambda: update_graphs(statesel, cumulincr, scale, movingaverage
+                                                                   , start_date, end_date, None))
+        timing.update({'states': count, 'range': name, 'CumulIncr': cumulincr, 'Scale': scale
+                       , 'MovingAverage': movingaverage, 'bytes': len(body)})
+        graphs.append(timing)
+    results['graphs'] = graphs
+    results['summary'] = {'graphs_median_ms': round(float(np.median([g['median_ms'] for g in graphs])), 3)
+                          , 'graphs_total_ms': round(sum(g['median_ms'] for g in graphs), 3)
+                          , 'graphs_alloc_peak_kb': max(g['alloc_peak_kb'] for g in graphs)}
+    return results
+
+
+''' COMPARE '''
+def graph_key(graph):
+    return (graph['states'], graph['range'], graph['CumulIncr'], graph['Scale'], graph['MovingAverage'])
+
+
+def compare(before, after):
+    lines = []
+    for k in ['full_load_ms']:
+        lines.append('%-34s %10.1f %10.1f %7.2fx' % (k, before['pipeline'][k], after['pipeline'][k]
+                                                     , before['pipeline'][k]/max(after['pipeline'][k], 1e-9)))
+    stages = after['pipeline']['stages_ms']
+    for k, v in sorted(before['pipeline']['stages_ms'].items()):
+        if k in stages:
+            lines.append('  %-32s %10.1f %10.1f %7.2fx' % (k, v, stages[k], v/max(stages[k], 1e-9)))
+
+    old = dict((graph_key(g), g) for g in before['graphs'])
+    ratios = []
+    for g in after['graphs']:
+        o = old.get(graph_key(g))
+        if o is not None:
+            ratios.append(o['median_ms']/max(g['median_ms'], 1e-9))
+    if ratios:
+        lines.append('%-34s %10.1f %10.1f %7.2fx' % ('graphs median_ms', before['summary']['graphs_median_ms']
+                                                     , after['summary']['graphs_median_ms']
+                                                     , float(np.exp(np.mean(np.log(ratios))))))
+        lines.append('%d graph cases, speedup geometric mean shown, min %.2fx max %.2fx' % (len(ratios), min(ratios), max(ratios)))
+    k = 'graphs_alloc_peak_kb'
+    if k in before['summary'] and k in after['summary']:
+        lines.append('%-34s %10.1f %10.1f %7.2fx' % (k, before['summary'][k], after['summary'][k]
+                                                     , before['summary'][k]/max(after['summary'][k], 1e-9)))
+    return lines
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks on synthetic data')
+    commands = parser.add_subparsers(dest='command')
+    g = commands.add_parser('generate', help='write synthetic source files')
+    g.add_argument('folder')
+    g.add_argument('--countries', type=int, default=200)
+    g.add_argument('--states', type=int, default=56)
+    g.add_argument('--days', type=int, default=365)
+    g.add_argument('--seed', type=int, default=0)
+    r = commands.add_parser('run', help='time the data load and the callbacks')
+    r.add_argument('folder')
+    r.add_argument('--out', help='JSON results file, printed when missing')
+    r.add_argument('--repeat', type=int, default=5)
+    r.add_argument('--quick', action='store_true', help='fewer input combinations')
+    c = commands.add_parser('compare', help='compare two results files')
+    c.add_argument('before')
+    c.add_argument('after')
+    args = parser.parse_args(argv)
+
+    if args.command == 'generate':
+        generate(args.folder, args.countries, args.states, args.days, args.seed)
+    elif args.command == 'run':
+        results = run(args.folder, args.repeat, args.quick)
+        text = json.dumps(results, indent=1, sort_keys=True)
+        if args.out:
+            with open(args.out, 'w') as f:
+                f.write(text)
+            print('full load %.1f ms, graphs median %.1f ms over %d cases, allocating at most %.1f KB' % (
+                results['pipeline']['full_load_ms'], results['summary']['graphs_median_ms'], len(results['graphs'])
+                , results['summary']['graphs_alloc_peak_kb']))
+        else:
+            print(text)
+    elif args.command == 'compare':
+        with open(args.before) as f:
+            before = json.load(f)
+        with open(args.after) as f:
+            after = json.load(f)
+        print('\n'.join(compare(before, after)))
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
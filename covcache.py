@@ -0,0 +1,118 @@
+import collections
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+
+''' FIGURE CACHE '''
+# Entries kept in each worker, and in the store shared by the workers
+figurecachesize = int(os.environ.get('COVID_FIGURE_CACHE_SIZE', 256))
+figuresharedsize = int(os.environ.get('COVID_FIGURE_SHARED_SIZE', 4096))
+
+# Serialized figure responses keyed by the normalized callback inputs. Every
+# entry belongs to a data snapshot version: the first entry stored for a new
+# version drops everything cached for older ones, so a data refresh
+# invalidates the cache without any extra bookkeeping.
+#
+# Lookups go to an in process LRU first, then to an optional sqlite file that
+# all the workers on the machine share, so a view rendered by one worker is a
+# hit in the others. The shared store drops its oldest entries when it is full
+# and the entries of versions first seen before the one being stored, so
+# workers still on the previous version for a moment do not drop the entries
+# of the new one. When the versions were seen is kept for the last few.
+# Each thread has its own connection and the sqlite reads and writes run
+# outside the lock of the LRU, so hits never wait for a commit.
+# Errors of the shared store are logged and treated as misses.
+class FigureCache(object):
+
+    def __init__(self, size=figurecachesize, path=None, sharedsize=figuresharedsize):
+        self.size = size
+        self.path = path
+        self.sharedsize = sharedsize
+        self.version = None
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.hits = 0
+        self.sharedhits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def shared(self):
+        # A connection per thread and process, gunicorn may fork after the
+        # cache is made
+        local = self.local
+        if getattr(local, 'connection', None) is None or local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=1)
+            connection.execute('create table if not exists figures'
+                               ' (key text primary key, version text, body blob, stored real)')
+            connection.execute('create table if not exists versions (version text primary key, seen real)')
+            connection.commit()
+            local.connection = connection
+            local.pid = os.getpid()
+        return local.connection
+
+    def get(self, key, version):
+        with self.lock:
+            body = self.entries.get((version, key))
+            if body is not None:
+                self.entries.move_to_end((version, key))
+                self.hits += 1
+                return body
+
+        row = None
+        if self.path:
+            try:
+                row = self.shared().execute('select body from figures where key = ? and version = ?'
+                                            , (key, version)).fetchone()
+            except sqlite3.Error:
+                log.exception('Shared figure cache lookup failed')
+
+        with self.lock:
+            if row is None:
+                self.misses += 1
+                return None
+            body = bytes(row[0])
+            self.remember(key, version, body)
+            self.hits += 1
+            self.sharedhits += 1
+            return body
+
+    def put(self, key, version, body):
+        with self.lock:
+            self.remember(key, version, body)
+        if not self.path:
+            return
+        try:
+            connection = self.shared()
+            connection.execute('insert or ignore into versions values (?, ?)', (version, time.time()))
+            older = 'select version from versions where seen < (select seen from versions where version = ?)'
+            connection.execute('delete from figures where version in (%s)' % older, (version,))
+            connection.execute('delete from versions where version not in'
+                               ' (select version from versions order by seen desc limit 16)')
+            connection.execute('insert or replace into figures values (?, ?, ?, ?)'
+                               , (key, version, sqlite3.Binary(body), time.time()))
+            connection.execute('delete from figures where key in (select key from figures'
+                               ' order by stored desc limit -1 offset ?)', (self.sharedsize,))
+            connection.commit()
+        except sqlite3.Error:
+            log.exception('Shared figure cache update failed')
+
+    def remember(self, key, version, body):
+        if version != self.version:
+            self.entries.clear()
+            self.version = version
+        self.entries[version, key] = body
+        self.entries.move_to_end((version, key))
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self):
+        return {'entries': len(self.entries), 'size': self.size, 'version': self.version
+                , 'hits': self.hits, 'sharedhits': self.sharedhits, 'misses': self.misses
+                , 'evictions': self.evictions}
@@ -0,0 +1,714 @@
+import collections
+import concurrent.futures
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+import pandas as pd
+import numpy as np
+from covsource import default_sources, fetch_sources
+from covstore import Rankings, SeriesStore, ViewCache, to_days
+from covtiming import etltimes
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+log = logging.getLogger(__name__)
+
+
+''' PREPARE WORLD DATA '''
+# US terriories are reported as US states in the US data
+usterritories = ['American Samoa', 'Guam', 'Northern Mariana Islands', 'Puerto Rico', 'United States Virgin Islands']
+
+worldfields = ['iso_code', 'location',	'date',	'total_cases', 'new_cases',	'total_deaths',	'new_deaths'
+               , 'total_cases_per_million',	'new_cases_per_million',	'total_deaths_per_million'
+               ,	'new_deaths_per_million', 'total_tests',	'new_tests',	'total_tests_per_thousand'
+               ,	'new_tests_per_thousand', 'tests_units']
+
+# Types of the world fields: labels as categories, counts as float64 so large
+# totals stay exact and the per million/thousand rates as float32
+worlddtypes = {'iso_code': 'category', 'location': 'category', 'tests_units': 'category'
+               , 'total_cases': 'float64', 'new_cases': 'float64', 'total_deaths': 'float64', 'new_deaths': 'float64'
+               , 'total_tests': 'float64', 'new_tests': 'float64'
+               , 'total_cases_per_million': 'float32', 'new_cases_per_million': 'float32'
+               , 'total_deaths_per_million': 'float32', 'new_deaths_per_million': 'float32'
+               , 'total_tests_per_thousand': 'float32', 'new_tests_per_thousand': 'float32'}
+
+# Rows of the OWID file parsed at a time
+worldchunksize = int(os.environ.get('COVID_WORLD_CHUNKSIZE', 50000))
+
+
+# Rows of a frame dated after the day in since for their jurisdiction, since
+# maps jurisdictions to the last day already loaded. Jurisdictions missing from
+# since keep all their rows.
+def after(frame, since, key='states', date='dateChecked'):
+    last = pd.Series(np.asarray(frame[key], dtype=object), index=frame.index).map(since)
+    return frame[~(to_days(frame[date]) <= last.values)]
+
+
+# Stream the OWID file in chunks, parsing only the world fields with compact
+# types and dropping the US territories chunk by chunk, so peak memory while
+# loading is bounded by the rows kept after pruning, in compact types, rather
+# than by the raw file. With since only the rows after the days already loaded
+# are kept.
+@etltimes.timed('world_read')
+def read_world(path, chunksize=worldchunksize, since=None):
+    chunks = []
+    with open(path, 'rb') as f:
+        for chunk in pd.read_csv(f, usecols=worldfields, dtype=worlddtypes, parse_dates=['date'], chunksize=chunksize):
+            chunk = chunk[~chunk['location'].isin(usterritories)]
+            if since is not None:
+                chunk = after(chunk, since, key='location', date='date')
+            chunks.append(chunk)
+    if not chunks:
+        return pd.DataFrame(columns=worldfields)
+
+    # Each chunk has its own categories, give them all the sorted union so the
+    # labels stay categorical through the concat
+    columns = ['iso_code', 'location', 'tests_units']
+    categories = dict((c, np.unique(np.concatenate([chunk[c].cat.categories.values for chunk in chunks])))
+                      for c in columns)
+    chunks = [chunk.assign(**dict((c, chunk[c].cat.set_categories(categories[c])) for c in columns))
+              for chunk in chunks]
+    return pd.concat(chunks, ignore_index=True)
+
+
+# Fill in blanks with the previous value of the same country. world is sorted
+# by country and date, so a single grouped pass does what filtering and
+# filling each country in turn did.
+@etltimes.timed('world_fill')
+def fill_forward(world, key='states'):
+    columns = [c for c in world.columns if c != key]
+    world[columns] = world.groupby(key, sort=False)[columns].ffill()
+    return world
+
+
+def load_world(path, since=None):
+    world = read_world(path, since=since)
+
+    # Select World Fields and Rename columns and sort data
+    world = world[worldfields]
+    world.columns = ['iso_code', 'states', 'dateChecked', 'positive', 'positiveIncrease', 'death', 'deathIncrease', 'positiveMil'
+                     , 'positiveIncreaseMil', 'deathMil', 'deathIncreaseMil', 'total', 'totalTestResultsIncrease', 'totalK'
+                     , 'totalTestResultsIncreaseK', 'testunits']
+
+    world = world.sort_values(by=['states', 'dateChecked'])
+
+    # Get country list and fill in blanks with previous values
+    countryall = np.asarray(world['states'].unique())
+    world = fill_forward(world)
+    world['states'] = world['states'].astype(object)
+
+    # Create missing columns that will be in US data
+    world['area'] = 'World'
+    world['fips'] = 0
+    world['negative'] = 0
+    world['hospitalized'] = 0
+    world['totalTestResults'] = world['total']
+    world['hospitalizedIncrease'] = 0
+    world['negativeIncrease'] = 0
+
+    world = pd.DataFrame(world[['dateChecked', 'area', 'states', 'positive', 'negative', 'hospitalized', 'death', 'total', 'totalTestResults', 'fips', 'deathIncrease'
+                     , 'hospitalizedIncrease', 'negativeIncrease', 'positiveIncrease', 'totalTestResultsIncrease', 'iso_code']])
+    return world, countryall
+
+
+''' PREPARE US DATA '''
+@etltimes.timed('us_read')
+def load_us(uspath, stpath, since=None):
+    covus = pd.read_csv(uspath)
+    covus.loc[covus['states']>1,'states'] = 'USA'
+    covst = pd.read_csv(stpath)
+    covst = covst[covst.dateChecked.notnull()]
+    covst.state = 'USA'+', '+covst.state
+
+    # The US data does not have a fips column, we add fips = 0
+    covus['fips'] = 0
+    covus['area'] = 'USA'
+    covst['area'] = 'USA'
+
+    # Select columns that are relevant, same columns for US and states
+    # Rename state columns to match US column names
+    covus = pd.DataFrame(covus[['dateChecked', 'area', 'states', 'positive', 'negative', 'hospitalized', 'death', 'total'
+                                , 'totalTestResults', 'fips', 'deathIncrease', 'hospitalizedIncrease'
+                                , 'negativeIncrease', 'positiveIncrease', 'totalTestResultsIncrease']])
+    covst = pd.DataFrame(covst[['dateChecked', 'area', 'state', 'positive', 'negative', 'hospitalized', 'death', 'total'
+                                , 'totalTestResults', 'fips', 'deathIncrease', 'hospitalizedIncrease'
+                                , 'negativeIncrease', 'positiveIncrease', 'totalTestResultsIncrease']])
+    covst.columns = ['dateChecked', 'area', 'states', 'positive', 'negative', 'hospitalized', 'death', 'total'
+                                , 'totalTestResults', 'fips', 'deathIncrease', 'hospitalizedIncrease'
+                                , 'negativeIncrease', 'positiveIncrease', 'totalTestResultsIncrease']
+
+    # Make the US dates, timestamps like 2020-04-01T20:00:00Z, days like the
+    # world dates that are parsed while reading: the day is the first ten
+    # characters, cut without splitting every string
+    for cov in [covus, covst]:
+        cov['dateChecked'] = pd.to_datetime(cov.dateChecked.str[:10])
+
+    if since is not None:
+        covus = after(covus, since)
+        covst = after(covst, since)
+    return covus, covst
+
+
+# Read us and world population data
+@etltimes.timed('population_read')
+def load_population(uspath, worldpath):
+    uspop = pd.read_csv(uspath)
+    uspop = uspop.iloc[:, 0:2]
+    uspop.columns =['states', 'population']
+    uspop.states = 'USA'+', '+uspop.states
+
+    worldpop = pd.read_csv(worldpath)
+    worldpop.columns = ['states', 'population']
+
+    return uspop.append(worldpop, sort=False)
+
+
+''' COMBINE WORLD AND US DATA'''
+@etltimes.timed('combine')
+def combine(world, countryall, covus, covst, pop):
+    # Get US state list and combined jurisdictions
+    statesall = covst['states'].unique()
+    statescountryall = np.concatenate([statesall, countryall])
+
+    # ISO codes of the countries, found by the jurisdiction search
+    codes = world[['states', 'iso_code']].dropna().drop_duplicates('states')
+    isocodes = dict(zip(codes['states'].astype(str), codes['iso_code'].astype(str)))
+    world = world.drop(columns=['iso_code'])
+
+    # Append the two dataframes
+    world = world.fillna(1)
+    worldusa = world.append([covus, covst], sort=False)
+
+    # Merge with population data and get state list
+    worldusa = pd.merge(worldusa, pop, on='states')
+
+    # Get US state list
+    statesall = worldusa[worldusa.area == 'USA']['states'].unique()
+
+    # Jurisdictions and areas become categories and dates int32 day numbers,
+    # labels are only looked up when plotting
+    worldusa['states'] = worldusa['states'].astype('category')
+    worldusa['area'] = worldusa['area'].astype('category')
+    worldusa['day'] = to_days(worldusa['dateChecked'])
+    worldusa = worldusa.drop(columns=['dateChecked'])
+
+    # Create dictionary of US states and world country lists
+    all_options = {'USA': statesall
+                   , 'World': countryall
+                   , 'All': statescountryall}
+    return worldusa, all_options, isocodes
+
+
+''' LOAD PIPELINE '''
+# Threads running the stages of a data load, by default one per CPU up to the
+# three independent branches. 1 runs them one after the other.
+etlworkers = int(os.environ.get('COVID_ETL_WORKERS', min(3, os.cpu_count() or 1)))
+
+# Stages of a data load as a DAG. A stage is a function called with the
+# results of the stages it depends on, every stage whose inputs are ready runs
+# at once on a thread pool: reading the CSVs and most of the pandas work
+# release the GIL, and threads hand the frames over without copying them.
+class Pipeline(object):
+
+    def __init__(self):
+        self.stages = collections.OrderedDict()
+
+    def add(self, name, function, *dependencies):
+        self.stages[name] = (function, dependencies)
+
+    # Results and wall time in seconds of every stage
+    def run(self, workers=etlworkers):
+        results = {}
+        seconds = {}
+        pending = collections.OrderedDict(self.stages)
+        running = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            while pending or running:
+                for name, (function, dependencies) in list(pending.items()):
+                    if all(d in results for d in dependencies):
+                        running[pool.submit(timed_call, function, [results[d] for d in dependencies])] = name
+                        del pending[name]
+                if not running:
+                    raise ValueError('stages %s wait on each other or on missing stages' % ', '.join(pending))
+                done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    results[name], seconds[name] = future.result()
+        return results, seconds
+
+
+def timed_call(function, args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+# Blanks left at the start of new world rows take the last stored value of
+# the country, where filling the whole history would have put it
+def seed_world(world, countryall, store):
+    lastrows = store.stops - 1
+    rows = world['states'].map(store.index)
+    known = rows.notnull().values
+    for c in storecolumns:
+        if c in world.columns:
+            seed = np.full(len(world), np.nan)
+            seed[known] = np.asarray(store.columns[c])[lastrows[rows[known].astype(np.int64).values]]
+            world[c] = world[c].fillna(pd.Series(seed, index=world.index))
+    return world, countryall
+
+
+# Combined table from the sources. The world branch and the US and population
+# reads are independent until combine, so the wall time is about the one of
+# the world branch. With since and store only the rows after the stored days
+# are prepared, see load_increment.
+def prepare(paths, since=None, store=None, workers=etlworkers):
+    pipeline = Pipeline()
+    pipeline.add('world', lambda: load_world(paths['world'], since))
+    world = 'world'
+    if store is not None:
+        pipeline.add('world_seed', lambda loaded: seed_world(loaded[0], loaded[1], store), 'world')
+        world = 'world_seed'
+    pipeline.add('us', lambda: load_us(paths['us'], paths['states'], since))
+    pipeline.add('population', lambda: load_population(paths['uspop'], paths['worldpop']))
+    pipeline.add('combine', lambda world, us, pop: combine(world[0], world[1], us[0], us[1], pop)
+                 , world, 'us', 'population')
+    with etltimes.time('prepare'):
+        results, seconds = pipeline.run(workers)
+    log.info('Prepared the data: %s', ', '.join('%s %.2fs' % item for item in seconds.items()))
+    return results['combine']
+
+
+''' SNAPSHOT '''
+# Layout of the snapshot files, snapshots in another layout are not read
+snapshotformat = 4
+
+# Jurisdictions kept per date in the rankings
+ranktop = int(os.environ.get('COVID_RANK_TOP', 25))
+
+# Numeric covall columns kept in the series store
+storecolumns = ['totalTestResults', 'positive', 'hospitalized', 'death', 'total', 'population'
+                , 'totalTestResultsIncrease', 'positiveIncrease', 'hospitalizedIncrease', 'deathIncrease']
+
+# One consistent set of prepared tables. The data of a snapshot is never
+# modified after it is built, a refresh builds a new one, so a callback that
+# took a reference to it keeps seeing the same data until it returns.
+#
+# created is when the sources were last checked for this data and rebuilt
+# when it was last built from the full sources rather than extended.
+# isocodes holds the ISO code of each country and stale the sources it was
+# built from stale copies of. The rankings are worked out from the views the
+# first time they are asked for.
+class Snapshot(object):
+
+    def __init__(self, store, views, all_options, version=None, created=None, rebuilt=None, isocodes=None):
+        self.store = store
+        self.views = views
+        self.all_options = all_options
+        self.isocodes = isocodes or {}
+        self.version = version or store_version(store)
+        self.created = created or time.time()
+        self.rebuilt = rebuilt or self.created
+        self.stale = []
+        self.ranked = None
+        self.ranking = threading.Lock()
+
+    def rankings(self):
+        with self.ranking:
+            if self.ranked is None:
+                with etltimes.time('rankings'):
+                    self.ranked = Rankings.from_store(self.store, self.views, self.all_options, ranktop)
+            return self.ranked
+
+
+# Derived from the content so workers that loaded the same data agree
+def store_version(store):
+    sha = hashlib.sha1(str(snapshotformat).encode())
+    sha.update(store.days.tobytes())
+    sha.update(store.starts.tobytes())
+    sha.update(store.stops.tobytes())
+    for c in sorted(store.columns):
+        sha.update(store.columns[c].tobytes())
+    sha.update(json.dumps(list(store.labels)).encode())
+    return sha.hexdigest()[:12]
+
+
+def build_snapshot(covall, all_options, metrics, isocodes=None):
+    with etltimes.time('store'):
+        store = SeriesStore.from_frame(covall, storecolumns)
+    with etltimes.time('views'):
+        views = ViewCache.from_store(store, metrics)
+    return Snapshot(store, views, all_options, isocodes=isocodes)
+
+
+# Sources that could not be reached, a refresh of data already served fails
+# rather than passing the copies it has for new data
+class SourcesUnavailable(Exception):
+    pass
+
+
+# Local copies of the sources, whether any changed and the sources only
+# available as the copy of an earlier fetch. Those raise SourcesUnavailable
+# unless stale copies are acceptable.
+def fetch(stale=False):
+    with etltimes.time('fetch'):
+        paths, changed, stalenames = fetch_sources(sources)
+    if stalenames and not stale:
+        raise SourcesUnavailable('could not fetch %s' % ', '.join(stalenames))
+    return paths, changed, stalenames
+
+
+# Snapshot of the full sources. With stale, when there is no data to serve
+# yet, the copies of sources that could not be reached are used and the
+# snapshot is dated when the oldest of them was downloaded rather than now.
+@etltimes.timed('full_load')
+def load_snapshot(metrics, stale=False):
+    paths, changed, stalenames = fetch(stale)
+    covall, all_options, isocodes = prepare(paths)
+    snapshot = build_snapshot(covall, all_options, metrics, isocodes)
+    if stalenames:
+        snapshot.created = snapshot.rebuilt = min(os.path.getmtime(paths[name]) for name in stalenames)
+        snapshot.stale = stalenames
+    return snapshot
+
+
+''' INCREMENTAL UPDATE '''
+# New data that can not just be appended to a snapshot
+class RebuildNeeded(Exception):
+    pass
+
+
+# Snapshot extended with the rows dated after the last stored day of each
+# jurisdiction. The sources are still read whole but only the new rows go
+# through the preparation, the stored rows and their views are copied over as
+# they are, so a refresh costs about the days added. Revised history is picked
+# up by the periodic full rebuild, a jurisdiction the snapshot does not have
+# raises RebuildNeeded. Sources that were not modified are not read at all.
+@etltimes.timed('increment_load')
+def load_increment(snapshot, metrics):
+    store = snapshot.store
+    paths, changed, stalenames = fetch()
+    if not changed:
+        return Snapshot(store, snapshot.views, snapshot.all_options, version=snapshot.version
+                        , rebuilt=snapshot.rebuilt, isocodes=snapshot.isocodes)
+
+    since = dict(zip(store.labels, np.asarray(store.days)[store.stops - 1].tolist()))
+    covall, all_options, isocodes = prepare(paths, since, store)
+    states = np.asarray(covall['states'], dtype=object)
+    unknown = sorted(set(states) - set(store.labels))
+    if unknown:
+        raise RebuildNeeded('new jurisdictions %s' % ', '.join(unknown[:5]))
+    if not len(covall):
+        return Snapshot(store, snapshot.views, snapshot.all_options, version=snapshot.version
+                        , rebuilt=snapshot.rebuilt, isocodes=snapshot.isocodes)
+
+    codes = np.array([store.index[state] for state in states], dtype=np.int64)
+    days = np.asarray(covall['day'], dtype=np.int32)
+    order = np.lexsort((days, codes))
+    codes = codes[order]
+    columns = {}
+    for c in storecolumns:
+        columns[c] = np.asarray(covall[c], dtype=float)[order]
+
+    with etltimes.time('store'):
+        extended, at = store.extend(codes, days[order], columns)
+    with etltimes.time('views'):
+        views = snapshot.views.extend(store, at, codes, columns, metrics)
+    return Snapshot(extended, views, snapshot.all_options, rebuilt=snapshot.rebuilt, isocodes=snapshot.isocodes)
+
+
+''' SNAPSHOT FILES '''
+# Prepared snapshots are written under snapshotdir, one directory per version
+# holding an .npy file per array, so they load memory mapped in milliseconds,
+# and a meta.json with the labels. The 'current' file names the latest
+# complete snapshot with the times it was checked and rebuilt, and is replaced
+# atomically. An empty COVID_SNAPSHOT_DIR turns the files off.
+snapshotdir = os.environ.get('COVID_SNAPSHOT_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'snapshot'))
+
+# Where the data is read from, see covsource. Downloads are kept next to the
+# snapshots so unchanged sources are not fetched again.
+sources = default_sources(os.path.join(snapshotdir, 'sources') if snapshotdir else None)
+
+@etltimes.timed('save')
+def save_snapshot(snapshot, path=snapshotdir):
+    target = os.path.join(path, snapshot.version)
+    if not os.path.isdir(target):
+        tmp = '%s.tmp%d' % (target, os.getpid())
+        os.makedirs(tmp)
+        for name in ['days', 'starts', 'stops']:
+            np.save(os.path.join(tmp, '%s.npy' % name), getattr(snapshot.store, name))
+        for c, values in snapshot.store.columns.items():
+            np.save(os.path.join(tmp, 'column-%s.npy' % c), values)
+        views = []
+        for kind in ['views', 'sums', 'bad']:
+            for (view, scale), cached in getattr(snapshot.views, kind).items():
+                for name, values in cached.items():
+                    filename = '%s-%s-%s-%s.npy' % (kind, view.replace(' ', ''), scale, name)
+                    np.save(os.path.join(tmp, filename), values)
+                    views.append([kind, view, scale, name, filename])
+        meta = {'format': snapshotformat
+                , 'version': snapshot.version
+                , 'created': snapshot.created
+                , 'rebuilt': snapshot.rebuilt
+                , 'columns': sorted(snapshot.store.columns)
+                , 'labels': list(snapshot.store.labels)
+                , 'views': views
+                , 'all_options': dict((k, list(v)) for k, v in snapshot.all_options.items())
+                , 'isocodes': snapshot.isocodes}
+        with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+        os.rename(tmp, target)
+
+    current = os.path.join(path, 'current')
+    with open(current + '.tmp%d' % os.getpid(), 'w') as f:
+        json.dump({'version': snapshot.version, 'created': snapshot.created, 'rebuilt': snapshot.rebuilt}, f)
+    os.replace(current + '.tmp%d' % os.getpid(), current)
+
+    # Keep the previous version around for readers still mapping it
+    versions = sorted((d for d in os.listdir(path) if '.tmp' not in d and os.path.isfile(os.path.join(path, d, 'meta.json')))
+                      , key=lambda d: os.path.getmtime(os.path.join(path, d)))
+    for d in versions[:-2]:
+        if d != snapshot.version:
+            shutil.rmtree(os.path.join(path, d), ignore_errors=True)
+
+
+# Content of the 'current' file, None if nothing was written yet
+def read_current(path=snapshotdir):
+    try:
+        with open(os.path.join(path, 'current')) as f:
+            current = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+    if not isinstance(current, dict) or not current.get('version'):
+        return None
+    return current
+
+
+# Snapshot on disk with its arrays memory mapped, the current one by default
+def read_snapshot(path=snapshotdir, version=None):
+    current = read_current(path) or {}
+    version = version or current.get('version')
+    if version is None:
+        return None
+
+    folder = os.path.join(path, version)
+    with open(os.path.join(folder, 'meta.json')) as f:
+        meta = json.load(f)
+    if meta.get('format') != snapshotformat:
+        log.info('Ignoring data snapshot %s written in an older format', version)
+        return None
+
+    arrays = {}
+    for name in ['days', 'starts', 'stops']:
+        arrays[name] = np.load(os.path.join(folder, '%s.npy' % name), mmap_mode='r')
+    columns = {}
+    for c in meta['columns']:
+        columns[c] = np.load(os.path.join(folder, 'column-%s.npy' % c), mmap_mode='r')
+    store = SeriesStore(meta['labels'], arrays['starts'], arrays['stops'], arrays['days'], columns)
+    views = {'views': {}, 'sums': {}, 'bad': {}}
+    for kind, view, scale, name, filename in meta['views']:
+        views[kind].setdefault((view, scale), {})[name] = np.load(os.path.join(folder, filename), mmap_mode='r')
+
+    snapshot = Snapshot(store, ViewCache(views['views'], views['sums'], views['bad']), meta['all_options']
+                        , version=meta['version'], created=meta['created'], rebuilt=meta.get('rebuilt')
+                        , isocodes=meta.get('isocodes'))
+    if current.get('version') == version:
+        snapshot.created = current.get('created', snapshot.created)
+        snapshot.rebuilt = current.get('rebuilt', snapshot.rebuilt)
+    return snapshot
+
+
+''' REFRESHER '''
+# Seconds between data refreshes, before retrying a refresh that failed and
+# between checks for a snapshot written by another worker
+refreshinterval = int(os.environ.get('COVID_REFRESH_INTERVAL', 6*60*60))
+refreshretry = int(os.environ.get('COVID_REFRESH_RETRY', 5*60))
+snapshotpoll = int(os.environ.get('COVID_SNAPSHOT_POLL', 30))
+
+# Seconds between full rebuilds, the refreshes in between only append the new
+# days. 0 rebuilds on every refresh.
+rebuildinterval = int(os.environ.get('COVID_REBUILD_INTERVAL', 24*60*60))
+
+# Serve only the snapshots on disk, never download
+offline = os.environ.get('COVID_OFFLINE', '') not in ('', '0')
+
+# Keeps data.snapshot current from a background thread and swaps each new
+# snapshot in with a single reference assignment. snapshot is None until the
+# first load finishes, a failed refresh keeps serving the previous snapshot.
+#
+# With a snapshot directory the gunicorn workers share the data: every worker
+# serves the current snapshot memory mapped from disk, so the arrays sit once
+# in the page cache whatever the number of workers, and follows the 'current'
+# file for new versions. Only the worker holding the directory lock downloads
+# when the snapshot is older than the refresh interval. A refresh appends the
+# new days to the snapshot being served unless a full rebuild is due.
+class DataRefresher(object):
+
+    def __init__(self, metrics, interval=refreshinterval, retry=refreshretry, poll=snapshotpoll
+                 , path=snapshotdir, offline=offline, rebuild=rebuildinterval):
+        self.metrics = metrics
+        self.interval = interval
+        self.rebuild = rebuild
+        self.retry = retry
+        self.poll = poll
+        self.path = path
+        self.offline = offline
+        self.snapshot = None
+        self.retry_at = 0
+        self.error = None
+        self.stopped = threading.Event()
+        self.thread = None
+        self.pid = None
+        self.starting = threading.Lock()
+
+    # Readiness of the data: idle until started, loading until the first
+    # snapshot is in, ready from then on and failed while the first load keeps
+    # failing. A failed refresh keeps a ready refresher serving its snapshot.
+    @property
+    def state(self):
+        if self.snapshot is not None:
+            return 'ready'
+        if self.error is not None:
+            return 'failed'
+        if self.thread is None:
+            return 'idle'
+        return 'loading'
+
+    # Switches to the snapshot on disk if it is not the one being served
+    def warm_start(self):
+        current = read_current(self.path)
+        if current is None:
+            return self.snapshot
+        version = current['version']
+        if self.snapshot is not None and self.snapshot.version == version:
+            # Another worker may have checked the sources and found nothing new
+            self.snapshot.created = max(self.snapshot.created, current.get('created', 0))
+            self.snapshot.rebuilt = max(self.snapshot.rebuilt, current.get('rebuilt', 0))
+            return self.snapshot
+        try:
+            snapshot = read_snapshot(self.path, version)
+        except Exception:
+            log.exception('Could not read the data snapshot in %s', self.path)
+            snapshot = None
+        if snapshot is not None:
+            self.snapshot = snapshot
+            log.info('Using data snapshot %s from %s', version, self.path)
+        return self.snapshot
+
+    def due(self):
+        if self.offline or time.time() < self.retry_at:
+            return False
+        return self.snapshot is None or self.snapshot.created + self.interval <= time.time()
+
+    def refresh(self):
+        snapshot = None
+        if self.snapshot is not None and time.time() < self.snapshot.rebuilt + self.rebuild:
+            try:
+                snapshot = load_increment(self.snapshot, self.metrics)
+            except RebuildNeeded as e:
+                log.info('Rebuilding the data snapshot: %s', e)
+            else:
+                log.info('Appended %d rows to the data snapshot'
+                         , len(snapshot.store.days) - len(self.snapshot.store.days))
+        if snapshot is None:
+            snapshot = load_snapshot(self.metrics, stale=self.snapshot is None)
+        self.snapshot = snapshot
+        log.info('Loaded data snapshot %s, %d rows', snapshot.version, len(snapshot.store.days))
+        if self.path:
+            try:
+                save_snapshot(snapshot, self.path)
+                # Serve the mapped files like the other workers and free our copy
+                self.snapshot = read_snapshot(self.path, snapshot.version)
+            except Exception:
+                log.exception('Could not write the data snapshot to %s', self.path)
+        return snapshot
+
+    # Non blocking lock held by the one process downloading into the directory
+    @contextlib.contextmanager
+    def lock(self):
+        if not self.path or fcntl is None:
+            yield True
+            return
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        with open(os.path.join(self.path, 'lock'), 'w') as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                acquired = True
+            except (IOError, OSError):
+                acquired = False
+            try:
+                yield acquired
+            finally:
+                if acquired:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def update(self):
+        if self.path:
+            self.warm_start()
+        if not self.due():
+            return
+        with self.lock() as acquired:
+            if not acquired:
+                return
+            # Another worker may have finished a download while we waited
+            if self.path:
+                self.warm_start()
+            if self.due():
+                try:
+                    snapshot = self.refresh()
+                except Exception as e:
+                    self.retry_at = time.time() + self.retry
+                    self.error = '%s: %s' % (type(e).__name__, e)
+                    raise
+                # Serving stale copies, dated when they were downloaded so the
+                # sources are tried again once that is older than the interval
+                if snapshot.stale:
+                    self.retry_at = time.time() + self.retry
+                    self.error = 'SourcesUnavailable: using stale copies of %s' % ', '.join(snapshot.stale)
+                    log.warning('Serving data from stale copies of %s', ', '.join(snapshot.stale))
+                else:
+                    self.error = None
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                self.update()
+                # Rankings are ready before the first request for them
+                if self.snapshot is not None:
+                    self.snapshot.rankings()
+            except Exception:
+                log.exception('Data refresh failed, retrying in %d seconds', self.retry)
+            self.stopped.wait(self.poll)
+
+    def start(self):
+        self.pid = os.getpid()
+        if self.path:
+            self.warm_start()
+        if self.offline and not self.path:
+            log.warning('Offline without a snapshot directory, there is no data to serve')
+            self.error = 'offline without a snapshot directory'
+            return
+        self.thread = threading.Thread(target=self.run, name='covid-data-refresh')
+        self.thread.daemon = True
+        self.thread.start()
+
+    # Starts once per process, threads do not survive a fork so a worker
+    # forked from a process that started its refresher starts its own
+    def ensure_started(self):
+        if self.pid == os.getpid():
+            return
+        with self.starting:
+            if self.pid != os.getpid():
+                self.thread = None
+                self.start()
+
+    def stop(self):
+        self.stopped.set()
@@ -0,0 +1,251 @@
+import hashlib
+import json
+import numpy as np
+import pandas as pd
+from covstore import VIEWS, SCALES, day_number, to_dates
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+
+''' EXPORT '''
+# Formats of the exported series and their content types. Arrow needs
+# pyarrow, which the app does not require.
+exportformats = {'csv': 'text/csv; charset=utf-8'
+                 , 'json': 'application/json'
+                 , 'arrow': 'application/vnd.apache.arrow.stream'}
+
+
+# Export request the data can not answer, reported as a 400
+class ExportError(ValueError):
+    pass
+
+
+# Column name of a metric in a CumulIncr view, like positive_rate_per_million
+def column_name(metric, view):
+    return '%s_%s' % (metric, view.lower().replace(' ', '_'))
+
+
+# Checked export request: jurisdictions, metrics and CumulIncr views, one
+# Scale, an optional moving average over any number of days and a date range
+class SeriesQuery(object):
+
+    def __init__(self, states, metrics, views, scale='Raw', average=None, start_date=None, end_date=None):
+        self.states = states
+        self.metrics = metrics
+        self.views = views
+        self.scale = scale
+        self.average = average
+        self.start_date = start_date
+        self.end_date = end_date
+
+    # From the query string: repeated state, metric and view parameters, scale,
+    # average, start and end. All jurisdictions, metrics and the Cumulative
+    # view by default.
+    @classmethod
+    def from_args(cls, args, store, metrics):
+        states = args.getlist('state') or store.keys()
+        unknown = [s for s in states if s not in store]
+        if unknown:
+            raise ExportError('unknown jurisdictions: %s' % ', '.join(unknown[:10]))
+
+        ids = [metric['id'] for metric in metrics]
+        names = args.getlist('metric') or ids
+        if any(name not in ids for name in names):
+            raise ExportError('metrics are %s' % ', '.join(ids))
+
+        views = args.getlist('view') or ['Cumulative']
+        if any(view not in VIEWS for view in views):
+            raise ExportError('views are %s' % ', '.join(VIEWS))
+
+        scale = args.get('scale', 'Raw')
+        if scale not in SCALES:
+            raise ExportError('scales are %s' % ', '.join(SCALES))
+
+        average = args.get('average')
+        if average is not None:
+            try:
+                average = int(average)
+            except ValueError:
+                average = 0
+            if average < 1:
+                raise ExportError('average is a number of days')
+
+        dates = []
+        for name in ['start', 'end']:
+            date = args.get(name)
+            if date is not None:
+                try:
+                    stamp = pd.Timestamp(date)
+                except ValueError:
+                    raise ExportError('%s is not a date' % name)
+                if pd.isnull(stamp):
+                    raise ExportError('%s is not a date' % name)
+                date = str(stamp.date())
+            dates.append(date)
+        return cls(states, names, views, scale, average, dates[0], dates[1])
+
+    def columns(self):
+        return [(column_name(metric, view), metric, view) for view in self.views for metric in self.metrics]
+
+    def key(self):
+        return json.dumps([self.states, self.metrics, self.views, self.scale, self.average
+                           , self.start_date, self.end_date])
+
+    def etag(self, version, format):
+        return etag(version, format + self.key())
+
+
+# ETag of an answer: the data snapshot and the request
+def etag(version, key):
+    return '%s-%s' % (version, hashlib.sha1(key.encode()).hexdigest()[:16])
+
+
+# Series of each jurisdiction in turn as (state, dates, columns), so a large
+# export is produced and sent one jurisdiction at a time
+def series(snapshot, query):
+    store = snapshot.store
+    views = snapshot.views
+    for state in query.states:
+        rows = store.rows(state, query.start_date, query.end_date)
+        columns = []
+        for view in query.views:
+            values = views.select((view, query.scale), query.metrics, rows, query.average)
+            columns += [values[:, i] for i in range(len(query.metrics))]
+        yield state, store.dates(rows), columns
+
+
+def csv_chunks(snapshot, query):
+    header = True
+    for state, dates, columns in series(snapshot, query):
+        frame = pd.DataFrame(dict([('state', state), ('date', dates.astype(str))]
+                                  + [(name, values) for (name, m, v), values in zip(query.columns(), columns)])
+                             , columns=['state', 'date'] + [name for name, m, v in query.columns()])
+        text = frame.to_csv(index=False, header=header)
+        header = False
+        yield text
+
+
+# Values for JSON, non finite ones as null
+def json_values(values):
+    return [v if np.isfinite(v) else None for v in values.tolist()]
+
+
+# One JSON document with a series object per jurisdiction, written as it goes
+def json_chunks(snapshot, query):
+    yield '{"version": %s, "scale": %s, "average": %s, "columns": %s, "series": [' % (
+        json.dumps(snapshot.version), json.dumps(query.scale), json.dumps(query.average)
+        , json.dumps([name for name, m, v in query.columns()]))
+    separator = ''
+    for state, dates, columns in series(snapshot, query):
+        item = dict([('state', state), ('dates', dates.astype(str).tolist())]
+                    + [(name, json_values(values)) for (name, m, v), values in zip(query.columns(), columns)])
+        yield separator + json.dumps(item)
+        separator = ', '
+    yield ']}'
+
+
+# File like sink handing out what the Arrow writer wrote so far
+class ChunkSink(object):
+
+    def __init__(self):
+        self.chunks = []
+        self.closed = False
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+# Arrow IPC stream with a record batch per jurisdiction
+def arrow_chunks(snapshot, query):
+    fields = [pyarrow.field('state', pyarrow.string()), pyarrow.field('date', pyarrow.date32())]
+    fields += [pyarrow.field(name, pyarrow.float64()) for name, m, v in query.columns()]
+    schema = pyarrow.schema(fields)
+    sink = ChunkSink()
+    writer = pyarrow.ipc.new_stream(sink, schema)
+    for state, dates, columns in series(snapshot, query):
+        arrays = [pyarrow.array([state]*len(dates), pyarrow.string()), pyarrow.array(dates, pyarrow.date32())]
+        arrays += [pyarrow.array(values, pyarrow.float64()) for values in columns]
+        writer.write_batch(pyarrow.RecordBatch.from_arrays(arrays, schema=schema))
+        yield sink.drain()
+    writer.close()
+    yield sink.drain()
+
+
+exporters = {'csv': csv_chunks, 'json': json_chunks, 'arrow': arrow_chunks}
+
+
+# Format asked for by the format parameter or else the Accept header
+def export_format(args, accept):
+    format = args.get('format')
+    if format is None:
+        format = accept.best_match(['text/csv', 'application/json', exportformats['arrow']], default='text/csv')
+        format = dict((t.split(';')[0], f) for f, t in exportformats.items()).get(format, 'csv')
+    if format not in exportformats:
+        raise ExportError('formats are %s' % ', '.join(sorted(exportformats)))
+    if format == 'arrow' and pyarrow is None:
+        raise ExportError('the arrow format needs pyarrow installed on the server')
+    return format
+
+
+# Jurisdictions with their ISO code, scopes and the span of their dates, all
+# of them or those in states
+def jurisdictions(snapshot, states=None):
+    store = snapshot.store
+    scopes = dict((scope, set(options)) for scope, options in snapshot.all_options.items())
+    days = np.asarray(store.days)
+    items = []
+    for state in store.keys() if states is None else states:
+        code = store.index[state]
+        first, last = to_dates(days[[store.starts[code], store.stops[code] - 1]]).astype(str)
+        items.append({'state': state, 'iso_code': snapshot.isocodes.get(state), 'first': first, 'last': last
+                      , 'scopes': sorted(scope for scope, options in scopes.items() if state in options)})
+    return items
+
+
+# Top jurisdictions of a scope on a date from the query string: metric, view,
+# scope, date, the last day of the data by default, and top
+def ranking(snapshot, args, metrics):
+    rankings = snapshot.rankings()
+    ids = [metric['id'] for metric in metrics]
+    metric = args.get('metric', 'death')
+    if metric not in ids:
+        raise ExportError('metrics are %s' % ', '.join(ids))
+    view = args.get('view', 'Cumulative')
+    if view not in VIEWS:
+        raise ExportError('views are %s' % ', '.join(VIEWS))
+    scope = args.get('scope', 'All')
+    if scope not in snapshot.all_options:
+        raise ExportError('scopes are %s' % ', '.join(sorted(snapshot.all_options)))
+    try:
+        top = int(args.get('top', 10))
+    except ValueError:
+        top = 0
+    if not 0 < top <= rankings.size:
+        raise ExportError('top is at most %d' % rankings.size)
+    first, last = rankings.days()
+    day = last
+    if 'date' in args:
+        try:
+            day = day_number(args['date'])
+        except ValueError:
+            raise ExportError('date is not a date')
+
+    items = rankings.top(scope, view, metric, day, top)
+    return {'version': snapshot.version, 'metric': metric, 'view': view, 'scope': scope, 'date': str(to_dates(day))
+            , 'first': str(to_dates(first)), 'last': str(to_dates(last))
+            , 'ranking': [{'rank': i + 1, 'state': state, 'value': value} for i, (state, value) in enumerate(items)]}
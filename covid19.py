@@ -1,117 +1,77 @@
 import dash
 import dash_core_components as dcc
 import dash_html_components as html
-import pandas as pd
+import flask
+import json
+import os
+import time
 import numpy as np
 import datetime as dt
-
-''' PREPARE WORLD DATA '''
-# Read data from https://covidtracking.com/ 
-urlworld = 'https://covid.ourworldindata.org/data/owid-covid-data.csv'
-world = pd.read_csv(urlworld)
-
-# Remove US terriories from world data
-usterritories = ['American Samoa', 'Guam', 'Northern Mariana Islands', 'Puerto Rico', 'United States Virgin Islands']
-world = world[~world['location'].isin(usterritories)]
-
-# Select World Fields and Rename columns and sort data
-worldfields = ['iso_code', 'location',	'date',	'total_cases', 'new_cases',	'total_deaths',	'new_deaths'
-               , 'total_cases_per_million',	'new_cases_per_million',	'total_deaths_per_million'
-               ,	'new_deaths_per_million', 'total_tests',	'new_tests',	'total_tests_per_thousand'
-               ,	'new_tests_per_thousand', 'tests_units']
-world = world[worldfields]
-world.columns = ['iso_code', 'states', 'dateChecked', 'positive', 'positiveIncrease', 'death', 'deathIncrease', 'positiveMil'
-                 , 'positiveIncreaseMil', 'deathMil', 'deathIncreaseMil', 'total', 'totalTestResultsIncrease', 'totalK'
-                 , 'totalTestResultsIncreaseK', 'testunits']
-
-world = world.sort_values(by=['states', 'dateChecked'])
-
-# Get country list and fill in blanks with previous values
-countryall = world['states'].unique()
-for w in countryall:
-    country = world.loc[world['states']==w]
-    country = country.fillna(method='ffill')
-    world.loc[world['states']==w] = country
-
-# Create missing columns that will be in US data
-world['area'] = 'World'
-world['fips'] = 0
-world['negative'] = 0
-world['hospitalized'] = 0
-world['totalTestResults'] = world['total']
-world['hospitalizedIncrease'] = 0
-world['negativeIncrease'] = 0
-
-world = pd.DataFrame(world[['dateChecked', 'area', 'states', 'positive', 'negative', 'hospitalized', 'death', 'total', 'totalTestResults', 'fips', 'deathIncrease'
-                 , 'hospitalizedIncrease', 'negativeIncrease', 'positiveIncrease', 'totalTestResultsIncrease']])
-                
-
-''' PREPARE US DATA '''
-# Read data from https://covidtracking.com/ 
-urlus = 'https://covidtracking.com/api/v1/us/daily.csv'
-urlst = 'https://covidtracking.com/api/v1/states/daily.csv'
-covus = pd.read_csv(urlus)
-covus.loc[covus['states']>1,'states'] = 'USA'
-covst = pd.read_csv(urlst)
-covst = covst[covst.dateChecked.notnull()]
-covst.state = 'USA'+', '+covst.state
-
-# Read us and world population data
-urluspop = 'https://github.com/mety19/covid19/raw/master/uspopulation.csv'
-uspop = pd.read_csv(urluspop)
-uspop = uspop.iloc[:, 0:2]
-uspop.columns =['states', 'population']
-uspop.states = 'USA'+', '+uspop.states
-
-urlworldpop = 'https://github.com/mety19/covid19/raw/master/worldpopulation.csv'
-worldpop = pd.read_csv(urlworldpop)
-worldpop.columns = ['states', 'population']
-
-pop = uspop.append(worldpop, sort=False)
-
-# The US data does not have a fips column, we add fips = 0
-covus['fips'] = 0
-covus['area'] = 'USA'
-covst['area'] = 'USA'
-
-# Select columns that are relevant, same columns for US and states
-# Rename state columns to match US column names
-covus = pd.DataFrame(covus[['dateChecked', 'area', 'states', 'positive', 'negative', 'hospitalized', 'death', 'total'
-                            , 'totalTestResults', 'fips', 'deathIncrease', 'hospitalizedIncrease'
-                            , 'negativeIncrease', 'positiveIncrease', 'totalTestResultsIncrease']])
-covst = pd.DataFrame(covst[['dateChecked', 'area', 'state', 'positive', 'negative', 'hospitalized', 'death', 'total'
-                            , 'totalTestResults', 'fips', 'deathIncrease', 'hospitalizedIncrease'
-                            , 'negativeIncrease', 'positiveIncrease', 'totalTestResultsIncrease']])
-covst.columns = ['dateChecked', 'area', 'states', 'positive', 'negative', 'hospitalized', 'death', 'total'
-                            , 'totalTestResults', 'fips', 'deathIncrease', 'hospitalizedIncrease'
-                            , 'negativeIncrease', 'positiveIncrease', 'totalTestResultsIncrease']
-
-# Get US state list and combined jurisdictions
-statesall = covst['states'].unique()
-statescountryall = np.concatenate([statesall, countryall])
-
-''' COMBINE WORLD AND US DATA'''
-# Append the two dataframes and make date, and dateindex datatime types 
-world = world.fillna(1)
-worldusa = world.append([covus, covst], sort=False)
-worldusa['dateChecked'] = worldusa.dateChecked.str.split('T').str[0]
-worldusa['Date'] = worldusa['Dateindex'] = pd.to_datetime(worldusa['dateChecked'])
-
-# Merge with population data and get state list
-worldusa = pd.merge(worldusa, pop, on='states')
-
-# Get US state list
-statesall = worldusa[worldusa.area == 'USA']['states'].unique()
-
-# Create dictionary of US states and world country lists
-all_options = {'USA': statesall
-               , 'World': countryall
-               , 'All': statescountryall}
-covall = worldusa
-
-# cumulative and incremental columns
-Cumulative = ['Date', 'states', 'totalTestResults', 'positive', 'hospitalized', 'death', 'total', 'population', 'Dateindex', 'dateChecked']
-Incremental = ['Date', 'states', 'totalTestResultsIncrease', 'positiveIncrease', 'hospitalizedIncrease', 'deathIncrease', 'total', 'population', 'Dateindex', 'dateChecked']
+from dash.exceptions import PreventUpdate
+from covcache import FigureCache
+from covdata import DataRefresher, snapshotdir
+from covexport import ExportError, SeriesQuery, etag, export_format, exportformats, exporters, jurisdictions, ranking
+from covsearch import SearchIndex, searchlimit
+from covserve import ComputeGate, Deadline, Overloaded
+from covstore import VIEWS, day_number, plot_points, plot_values, to_dates
+from covtiming import Stages, callbacktimes, graphtimes, histograms, profiledir, requesttimes, sample
+from covtiming import save_profile, start_profile
+
+# Graph metrics: cumulative and daily columns, the column the Other Rates view
+# is divided by, the cap above which those rates are zeroed, the plot titles
+# and the name of the metric in the ranking
+metrics = [
+        {'id': 'tests', 'cumulative': 'totalTestResults', 'incremental': 'totalTestResultsIncrease', 'per': 'population', 'label': 'Tests'
+         , 'titles': {'Cumulative': 'Cumulative Number of Tests'
+                      , 'Incremental': 'Daily Number of Tests'
+                      , 'Rate Per Million': 'Number of Tests per Million Residents'
+                      , 'Other Rates': 'Number of Tests per Resident'}},
+        {'id': 'positive', 'cumulative': 'positive', 'incremental': 'positiveIncrease', 'per': 'total', 'cap': 0.99, 'label': 'Positive Tests'
+         , 'titles': {'Cumulative': 'Cumulative Number of Positive Tests'
+                      , 'Incremental': 'Daily Number of Positive Tests'
+                      , 'Rate Per Million': 'Number of Positive Tests per Million Residents'
+                      , 'Other Rates': 'Number of Positive Tests per Test'}},
+        {'id': 'hospitalized', 'cumulative': 'hospitalized', 'incremental': 'hospitalizedIncrease', 'per': 'positive', 'label': 'Hospitalized Patients'
+         , 'titles': {'Cumulative': 'Cumulative Number of Hospitalized Patients'
+                      , 'Incremental': 'Daily Number of Hospitalized Patients'
+                      , 'Rate Per Million': 'Number of Hospitalized Patients per Million Residents'
+                      , 'Other Rates': 'Number of Hospitalized Patients per Positive Test'}},
+        {'id': 'death', 'cumulative': 'death', 'incremental': 'deathIncrease', 'per': 'positive', 'label': 'Deaths'
+         , 'titles': {'Cumulative': 'Cumulative Number of Deaths'
+                      , 'Incremental': 'Daily Number Deaths'
+                      , 'Rate Per Million': 'Number of Deaths per Million Residents'
+                      , 'Other Rates': 'Number of Deaths per Positive Test'}}
+        ]
+
+# Data is loaded and refreshed in the background once the app serves its
+# first request or create_app is called, callbacks read data.snapshot
+data = DataRefresher(metrics)
+
+scopes = ['USA', 'World', 'All']
+
+# Rows averaged by each Smoothing choice, any window costs the same
+windows = {'Moving Average 3-Day': 3, 'Moving Average 7-Day': 7, 'Moving Average 14-Day': 14}
+
+# Most points sent per trace, about the pixel width of a half width graph, and
+# significant digits of the values sent. 0 sends every point at full precision.
+plotpoints = int(os.environ.get('COVID_PLOT_POINTS', 1000))
+plotdigits = int(os.environ.get('COVID_PLOT_DIGITS', 6))
+
+# With COVID_CLIENTSIDE=1 the server only sends the series of the selected
+# jurisdictions, the browser works out the views, scales, averages and date
+# windows from them (see CLIENTSIDE TRANSFORMS)
+clientside = os.environ.get('COVID_CLIENTSIDE', '') not in ('', '0')
+
+# Serialized graph responses, shared by the workers next to the data snapshots
+figures = FigureCache(path=os.path.join(snapshotdir, 'figures.sqlite') if snapshotdir else None)
+
+
+# Snapshot used for the current request, the same one from the cache lookup
+# to the callback even if a refresh swaps data.snapshot in between
+def current_snapshot():
+    if flask.has_request_context() and 'snapshot' in flask.g:
+        return flask.g.snapshot
+    return data.snapshot
 
 
 ''' APP '''
@@ -119,6 +79,31 @@ external_stylesheets = ['https://codepen.io/chriddyp/pen/bWLwgP.css']
 app = dash.Dash(__name__, external_stylesheets=external_stylesheets)
 server = app.server
 
+# The app and its layout are built on import without touching the data, so
+# importing the module is cheap and the server answers right away, showing
+# the loading state until the first data load is done
+def create_app(start=True):
+    if start:
+        data.ensure_started()
+    return app
+
+@server.before_request
+def start_data():
+    data.ensure_started()
+
+# Liveness, and readiness once a data snapshot is being served
+@server.route('/healthz')
+def health():
+    return flask.jsonify({'status': 'ok'})
+
+@server.route('/ready')
+def ready():
+    snapshot = data.snapshot
+    status = {'state': data.state, 'error': data.error}
+    if snapshot is not None:
+        status.update({'version': snapshot.version, 'rows': len(snapshot.store.days), 'created': snapshot.created})
+    return flask.jsonify(status), 200 if snapshot is not None else 503
+
 app.css.append_css({'external_url': 'https://codepen.io/amyoshino/pen/jzXypZ.css'})
 
 colors = {
@@ -133,7 +118,11 @@ app.layout = html.Div(style={'backgroundColor': colors['background']}, children=
         html.H1(children='World and USA SARS-COV-2 Testing and COVID-19 Tracking', style={
             'textAlign': 'center',
             'color': colors['text']
-            })    
+            }),
+        html.P(id = 'DataStatus', children = 'Loading data...', style = {
+            'textAlign': 'center',
+            'color': 'Yellow'
+            })
     ], className = "row"),
     
  
@@ -177,7 +166,7 @@ app.layout = html.Div(style={'backgroundColor': colors['background']}, children=
                 dcc.RadioItems(
                     id = 'Scope',
                     options = [
-                            {'label': k, 'value': k} for k in all_options.keys()
+                            {'label': k, 'value': k} for k in scopes
                             ],
                     style={'backgroundcolor': '#030A32', 'color': '#FEFCFC'},
                     value = 'All'
@@ -220,7 +209,8 @@ app.layout = html.Div(style={'backgroundColor': colors['background']}, children=
                     options=[
                         {'label': 'None', 'value': 'None'},
                         {'label': 'Moving Average 3-Day', 'value': 'Moving Average 3-Day'},
-                        {'label': 'Moving Average 7-Day', 'value': 'Moving Average 7-Day'}
+                        {'label': 'Moving Average 7-Day', 'value': 'Moving Average 7-Day'},
+                        {'label': 'Moving Average 14-Day', 'value': 'Moving Average 14-Day'}
                         ],
                     style={'backgroundcolor': '#030A32', 'color': '#FEFCFC', 'size': 10},
                     value='None'
@@ -336,6 +326,43 @@ app.layout = html.Div(style={'backgroundColor': colors['background']}, children=
         ], className = "six columns")
     ], className = "row", style={'margin-top': '20'}),
 
+    # Jurisdictions of the scope leading on a metric for the Values choice
+    html.Div([
+        html.Div([
+            html.P('Ranking:', style = {'backgroundcolor': '#030A32', 'color': '#FEFCFC'}),
+            dcc.RadioItems(
+                    id = 'RankMetric',
+                    options = [
+                            {'label': metric['label'], 'value': metric['id']} for metric in metrics
+                            ],
+                    style={'backgroundcolor': '#030A32', 'color': '#FEFCFC'},
+                    value = 'death'
+                    ),
+            html.P('On:', style = {'backgroundcolor': '#030A32', 'color': '#FEFCFC'}),
+            dcc.DatePickerSingle(
+                    id = 'RankDate',
+                    placeholder = 'Latest',
+                    clearable = True
+                    )
+            ], className = 'two columns', style = {'margin-top': '20'}),
+        html.Div([
+            dcc.Graph(
+                id='ranking',
+                figure={
+                    'data': [],
+                    'layout': {
+                        'title': 'Ranking',
+                        'plot_bgcolor': '#030A32',
+                        'paper_bgcolor': '#030A32',
+                        'font': {
+                            'color': colors['text']
+                        }
+                    }
+                }
+            )
+        ], className = "ten columns")
+    ], className = "row", style={'margin-top': '20'}),
+
     
     html.Div([
             html.P('For questions or comments contact'
@@ -353,84 +380,72 @@ app.layout = html.Div(style={'backgroundColor': colors['background']}, children=
                                         'textAlign': 'center',
                                         'color': '#DFD9D9'
                                     })
-            ], className="row", style={'margin-top': '20'})
+            ], className="row", style={'margin-top': '20'}),
+
+    # Version of the data shown, polled quickly until the first load is done
+    dcc.Store(id = 'DataVersion'),
+    dcc.Interval(id = 'DataCheck', interval = 2*1000)
 
 ])
 
 
+# Picks up a new data snapshot and slows the polling down once data is loaded,
+# showing the loading state until then
+datastatus = {'idle': 'Loading data...', 'loading': 'Loading data...'
+              , 'failed': 'The data could not be loaded yet, retrying...'}
+
+@app.callback(
+        [dash.dependencies.Output('DataVersion', 'data')
+        , dash.dependencies.Output('DataCheck', 'interval')
+        , dash.dependencies.Output('DataStatus', 'children')],
+        [dash.dependencies.Input('DataCheck', 'n_intervals')],
+        [dash.dependencies.State('DataVersion', 'data')]
+        )
+@callbacktimes.timed('check_data_version')
+def check_data_version(n_intervals, version):
+    snapshot = data.snapshot
+    if snapshot is None:
+        return dash.no_update, dash.no_update, datastatus[data.state]
+    if snapshot.version == version:
+        raise PreventUpdate
+    return snapshot.version, 60*1000, ''
+
+# Search index of the jurisdictions of the latest snapshot
+searchindexes = {}
+
+def search_index(snapshot):
+    index = searchindexes.get(snapshot.version)
+    if index is None:
+        index = SearchIndex(snapshot.all_options, snapshot.isocodes)
+        searchindexes.clear()
+        searchindexes[snapshot.version] = index
+    return index
+
+# The State options are loaded as the user types: the best matches of what was
+# typed in the scope, by name, ISO or postal code or alias, and the selected
+# jurisdictions so they stay displayed
 @app.callback(
         dash.dependencies.Output('State', 'options'),
-        [dash.dependencies.Input('Scope', 'value')]
+        [dash.dependencies.Input('Scope', 'value')
+        , dash.dependencies.Input('State', 'search_value')
+        , dash.dependencies.Input('DataVersion', 'data')],
+        [dash.dependencies.State('State', 'value')]
         )
-def set_scope_option(selected_scope):
-    return [{'label': k, 'value': k} for k in all_options[selected_scope]]
+@callbacktimes.timed('set_scope_option')
+def set_scope_option(selected_scope, search_value, version, selected):
+    snapshot = current_snapshot()
+    if snapshot is None:
+        return []
+    options = search_index(snapshot).options(selected_scope, search_value or '')
+    shown = set(option['value'] for option in options)
+    return [{'label': k, 'value': k} for k in selected or [] if k not in shown] + options
     
-@app.callback(
-        dash.dependencies.Output('tests', 'figure'),
-        [dash.dependencies.Input('State', 'value')
-        , dash.dependencies.Input('CumulIncr', 'value')
-        , dash.dependencies.Input('Scale', 'value')
-        , dash.dependencies.Input('MovingAverage', 'value')
-        , dash.dependencies.Input('DateChoice', 'start_date')
-        , dash.dependencies.Input('DateChoice', 'end_date')
-        ])
-def update_graph_src(statesel, cumulincr, scale, movingaverage, start_date, end_date):
-    data = []
-    if cumulincr=='Cumulative':
-        covsel = covall[Cumulative]
-        covsel = covsel.round(2)
-        plottitle = 'Cumulative Number of Tests'
-    elif cumulincr=='Incremental':
-        covsel = covall[Incremental]
-        covsel = covsel.round(2)
-        plottitle = 'Daily Number of Tests'
-    elif cumulincr=='Rate Per Million':
-        covsel = covall[Cumulative]
-        covsel.iloc[:,2:7] = 1000000*covsel.iloc[:,2:7].div(covsel.population, axis=0)
-        covsel = covsel.round(0)
-        plottitle = 'Number of Tests per Million Residents'
-    elif cumulincr=='Other Rates':
-        covsel = covall[Cumulative]
-        covsel.iloc[:,2:7] = covsel.iloc[:,2:7].div(covsel.population, axis=0)
-        covsel = covsel.round(4)
-        plottitle = 'Number of Tests per Resident'
-        
-    if scale =='Raw':
-        covsel = covsel
-    elif scale=='Log10':
-        covsel.iloc[:,2:7] = np.log10(covsel.iloc[:,2:7])      
-        
-    covsel = covsel.sort_values(by='Dateindex')
-    covsel.set_index('Dateindex', inplace=True)
-    covsel = covsel.loc[start_date:end_date]
-        
-    for state in statesel:
-        covstate = pd.DataFrame(covsel.loc[covsel['states'] == state])
-        if movingaverage =='None':
-            covstate = covstate
-        elif movingaverage == 'Moving Average 3-Day':
-            covstate.iloc[:,2] = covstate.iloc[:,2].rolling(3).mean().shift(-2)
-        elif movingaverage == 'Moving Average 7-Day':
-            covstate.iloc[:,2] = covstate.iloc[:,2].rolling(7).mean().shift(-6)
-        data.append({'x':  covstate.Date, 'y': covstate.iloc[:,2], 'type': 'line'
-                     , 'mode': 'lines+markers', 'type': 'line', 'marker': {'size': 8}, 'line': {'width' : 3}, 'name': state})
-                               
+# Style shared by every trace, sent once per graph through the layout template
+# rather than with each trace
+tracetemplate = {'data': {'scatter': [{'mode': 'lines+markers', 'marker': {'size': 8}, 'line': {'width' : 3}}]}}
+
+def graph_figure(data, plottitle, scale):
     if scale == 'Raw':                         
-        figure = {
-                'data': data,
-                'layout': {
-                            'title': plottitle,
-                            'plot_bgcolor': '282D46',
-                            'paper_bgcolor': '282D46',
-                            'font': {
-                                'color': colors['text'],
-                                'size' : 16
-                            }
-                        }
-                }
-        return figure
-    
-    elif scale == 'Log10':                         
         figure = {
                 'data': data,
                 'layout': {
@@ -441,74 +456,7 @@ def update_graph_src(statesel, cumulincr, scale, movingaverage, start_date, end_
                                 'color': colors['text'],
                                 'size' : 16
                             },
-                            'yaxis': {
-                                    'tickvals': [0,1,2,3,4,5,6,7,8],
-                                    'ticktext': ['1', '10', '100', '1K', '10K', '100K', '1M', '10M', '100M']
-                                    }
-                        }
-                }
-        return figure
-      
-@app.callback(
-        dash.dependencies.Output('positive', 'figure'),
-        [dash.dependencies.Input('State', 'value')
-        , dash.dependencies.Input('CumulIncr', 'value')
-        , dash.dependencies.Input('Scale', 'value')
-        , dash.dependencies.Input('MovingAverage', 'value')
-        , dash.dependencies.Input('DateChoice', 'start_date')
-        , dash.dependencies.Input('DateChoice', 'end_date')
-        ])
-def update_graph_src(statesel, cumulincr, scale, movingaverage, start_date, end_date):
-    data = []
-    if cumulincr=='Cumulative':
-        covsel = covall[Cumulative]
-        plottitle = 'Cumulative Number of Positive Tests'
-    elif cumulincr=='Incremental':
-        covsel = covall[Incremental]
-        plottitle = 'Daily Number of Positive Tests'
-    elif cumulincr=='Rate Per Million':
-        covsel = covall[Cumulative]
-        covsel.iloc[:,2:7] = 1000000*(covsel.iloc[:,2:7].div(covsel.population, axis=0))
-        covsel = covsel.round(0)
-        plottitle = 'Number of Positive Tests per Million Residents'
-    elif cumulincr=='Other Rates':
-        covsel = covall[Cumulative]
-        covsel.iloc[:,2:7] = (covsel.iloc[:,2:7].div(covsel.total, axis=0))
-        covsel = covsel.round(4)
-        covsel.iloc[:,2:7]=covsel.iloc[:,2:7].mask(covsel.iloc[:,2:7].gt(0.99),0)
-        plottitle = 'Number of Positive Tests per Test'
-        
-    if scale =='Raw':
-        covsel = covsel
-    elif scale=='Log10':
-        covsel.iloc[:,2:7] = np.log10(covsel.iloc[:,2:7])      
-        
-    covsel = covsel.sort_values(by='Dateindex')
-    covsel.set_index('Dateindex', inplace=True)
-    covsel = covsel.loc[start_date:end_date]   
-    
-    for state in statesel:
-        covstate = pd.DataFrame(covsel.loc[covsel['states'] == state])
-        if movingaverage =='None':
-            covstate = covstate
-        elif movingaverage == 'Moving Average 3-Day':
-            covstate.iloc[:,3] = covstate.iloc[:,3].rolling(3).mean().shift(-2)
-        elif movingaverage == 'Moving Average 7-Day':
-            covstate.iloc[:,3] = covstate.iloc[:,3].rolling(7).mean().shift(-6)
-        data.append({'x':  covstate.Date, 'y': covstate.iloc[:,3], 'type': 'line'
-                     , 'mode': 'lines+markers', 'type': 'line', 'marker': {'size': 8}, 'line': {'width' : 3}, 'name': state})
-        
-    if scale == 'Raw':                         
-        figure = {
-                'data': data,
-                'layout': {
-                            'title': plottitle,
-                            'plot_bgcolor': '282D46',
-                            'paper_bgcolor': '282D46',
-                            'font': {
-                                'color': colors['text'],
-                                'size' : 16
-                            }
+                            'template': tracetemplate
                         }
                 }
         return figure
@@ -527,175 +475,372 @@ def update_graph_src(statesel, cumulincr, scale, movingaverage, start_date, end_
                             'yaxis': {
                                     'tickvals': [0,1,2,3,4,5,6,7,8],
                                     'ticktext': ['1', '10', '100', '1K', '10K', '100K', '1M', '10M', '100M']
-                                    }
-                        }
-                }
-        return figure
-  
-@app.callback(
-        dash.dependencies.Output('hospitalized', 'figure'),
-        [dash.dependencies.Input('State', 'value')
-        , dash.dependencies.Input('CumulIncr', 'value')
-        , dash.dependencies.Input('Scale', 'value')
-        , dash.dependencies.Input('MovingAverage', 'value')
-        , dash.dependencies.Input('DateChoice', 'start_date')
-        , dash.dependencies.Input('DateChoice', 'end_date')
-        ])
-def update_graph_src(statesel, cumulincr, scale, movingaverage, start_date, end_date):
-    data = []
-    if cumulincr=='Cumulative':
-        covsel = covall[Cumulative]
-        plottitle = 'Cumulative Number of Hospitalized Patients'
-    elif cumulincr=='Incremental':
-        covsel = covall[Incremental]
-        plottitle = 'Daily Number of Hospitalized Patients'
-    elif cumulincr=='Rate Per Million':
-        covsel = covall[Cumulative]
-        covsel.iloc[:,2:7] = 1000000*covsel.iloc[:,2:7].div(covsel.population, axis=0)
-        covsel = covsel.round(0)
-        plottitle = 'Number of Hospitalized Patients per Million Residents'
-    elif cumulincr=='Other Rates':
-        covsel = covall[Cumulative]
-        covsel.iloc[:,2:7] = covsel.iloc[:,2:7].div(covsel.iloc[:,3], axis=0)
-        covsel = covsel.round(4)
-        plottitle = 'Number of Hospitalized Patients per Positive Test'
-        
-    if scale =='Raw':
-        covsel = covsel
-    elif scale=='Log10':
-        covsel.iloc[:,2:7] = np.log10(covsel.iloc[:,2:7])      
-        
-    covsel = covsel.sort_values(by='Dateindex')
-    covsel.set_index('Dateindex', inplace=True)
-    covsel = covsel.loc[start_date:end_date]
-        
-    for state in statesel:
-        covstate = pd.DataFrame(covsel.loc[covsel['states'] == state])
-        if movingaverage =='None':
-            covstate = covstate
-        elif movingaverage == 'Moving Average 3-Day':
-            covstate.iloc[:,4] = covstate.iloc[:,4].rolling(3).mean().shift(-2)
-        elif movingaverage == 'Moving Average 7-Day':
-            covstate.iloc[:,4] = covstate.iloc[:,4].rolling(7).mean().shift(-6)
-        data.append({'x':  covstate.Date, 'y': covstate.iloc[:,4], 'type': 'line'
-                     , 'mode': 'lines+markers', 'type': 'line', 'marker': {'size': 8}, 'line': {'width' : 3}, 'name': state})
-                                  
-    if scale == 'Raw':                         
-        figure = {
-                'data': data,
-                'layout': {
-                            'title': plottitle,
-                            'plot_bgcolor': '282D46',
-                            'paper_bgcolor': '282D46',
-                            'font': {
-                                'color': colors['text'],
-                                'size' : 16
-                            }
+                                    },
+                            'template': tracetemplate
                         }
                 }
         return figure
+
+# All four graphs come from one callback: the selected rows and dates of each
+# jurisdiction are worked out once and shared by every metric
+graphsoutputs = [dash.dependencies.Output(metric['id'], 'figure') for metric in metrics]
+graphsinputs = [dash.dependencies.Input('State', 'value')
+                , dash.dependencies.Input('CumulIncr', 'value')
+                , dash.dependencies.Input('Scale', 'value')
+                , dash.dependencies.Input('MovingAverage', 'value')
+                , dash.dependencies.Input('DateChoice', 'start_date')
+                , dash.dependencies.Input('DateChoice', 'end_date')
+                , dash.dependencies.Input('DataVersion', 'data')
+                ]
+
+@callbacktimes.timed('update_graphs')
+def update_graphs(statesel, cumulincr, scale, movingaverage, start_date, end_date, version):
+    start = time.perf_counter()
+    stages = Stages(graphtimes)
+    traces = [[] for metric in metrics]
     
-    elif scale == 'Log10':                         
-        figure = {
-                'data': data,
-                'layout': {
-                            'title': plottitle,
-                            'plot_bgcolor': '282D46',
-                            'paper_bgcolor': '282D46',
-                            'font': {
-                                'color': colors['text'],
-                                'size' : 16
-                            },
-                            'yaxis': {
-                                    'tickvals': [0,1,2,3,4,5,6,7,8],
-                                    'ticktext': ['1', '10', '100', '1K', '10K', '100K', '1M', '10M', '100M']
-                                    }
-                        }
-                }
-        return figure
+    # Empty graphs until the first data load is done
+    snapshot = current_snapshot()
+    if snapshot is not None:
+        store = snapshot.store
+        views = snapshot.views
+        window = windows.get(movingaverage)
+        deadline = request_deadline()
+        for state in statesel:
+            deadline.check()
+            with stages.time('rows'):
+                rows = store.rows(state, start_date, end_date)
+                dates = np.datetime_as_string(store.dates(rows))
+            with stages.time('values'):
+                covstate = views.select((cumulincr, scale), [metric['id'] for metric in metrics], rows, window)
+            # Dates go as plain YYYY-MM-DD strings, long ranges only with the
+            # points that show on the graph
+            with stages.time('traces'):
+                for i in range(len(metrics)):
+                    kept = plot_points(covstate[:, i], plotpoints)
+                    traces[i].append({'x': dates[kept].tolist(), 'y': plot_values(covstate[kept, i], plotdigits).tolist()
+                                      , 'name': state})
+    
+    with stages.time('figures'):
+        graphs = [graph_figure(traces[i], metric['titles'][cumulincr], scale) for i, metric in enumerate(metrics)]
+    stages.observe()
+    if flask.has_request_context():
+        flask.g.graphs_seconds = time.perf_counter() - start
+    return graphs
+
+
+''' CLIENTSIDE TRANSFORMS '''
+# In clientside mode the Series store holds the whole history of every view of
+# every metric of the selected jurisdictions, Raw and rounded like the graphs,
+# and only changes with the selection or the data. The graphs are drawn from it
+# by covid.graphs in assets/transforms.js: changing the view, scale, smoothing
+# or dates does not reach the server.
+@callbacktimes.timed('update_series')
+def update_series(statesel, version):
+    series = {'version': version, 'states': [], 'series': {}}
+    snapshot = current_snapshot()
+    if snapshot is None:
+        return series
+    store = snapshot.store
+    ids = [metric['id'] for metric in metrics]
+    deadline = request_deadline()
+    for state in statesel or []:
+        deadline.check()
+        rows = store.rows(state)
+        item = {'dates': np.datetime_as_string(store.dates(rows)).tolist()}
+        for view in VIEWS:
+            values = snapshot.views.select((view, 'Raw'), ids, rows)
+            item[view] = dict((name, plot_values(values[:, i], plotdigits).tolist()) for i, name in enumerate(ids))
+        series['states'].append(state)
+        series['series'][state] = item
+    return series
+
+# What the browser needs to draw the figures like graph_figure does
+def graph_settings():
+    return {'metrics': [metric['id'] for metric in metrics]
+            , 'titles': dict((metric['id'], metric['titles']) for metric in metrics)
+            , 'layouts': dict((scale, graph_figure([], '', scale)['layout']) for scale in ['Raw', 'Log10'])
+            , 'windows': windows}
+
+if clientside:
+    app.layout.children += [dcc.Store(id = 'Series'), dcc.Store(id = 'GraphSettings', data = graph_settings())]
+    update_series = app.callback(
+            dash.dependencies.Output('Series', 'data'),
+            [dash.dependencies.Input('State', 'value')
+            , dash.dependencies.Input('DataVersion', 'data')]
+            )(update_series)
+    app.clientside_callback(
+            dash.dependencies.ClientsideFunction(namespace = 'covid', function_name = 'graphs'),
+            graphsoutputs,
+            [dash.dependencies.Input('Series', 'data')] + graphsinputs[1:6],
+            [dash.dependencies.State('GraphSettings', 'data')]
+            )
+else:
+    update_graphs = app.callback(graphsoutputs, graphsinputs)(update_graphs)
+
 
+''' RANKINGS '''
+# Jurisdictions shown in the ranking graph
+rankshown = 10
+
+# Ranking of the scope on the chosen day, the last day of the data by default,
+# read from the rankings of the snapshot
 @app.callback(
-        dash.dependencies.Output('death', 'figure'),
-        [dash.dependencies.Input('State', 'value')
+        dash.dependencies.Output('ranking', 'figure'),
+        [dash.dependencies.Input('Scope', 'value')
         , dash.dependencies.Input('CumulIncr', 'value')
         , dash.dependencies.Input('Scale', 'value')
-        , dash.dependencies.Input('MovingAverage', 'value')
-        , dash.dependencies.Input('DateChoice', 'start_date')
-        , dash.dependencies.Input('DateChoice', 'end_date')
-        ])
-def update_graph_src(statesel, cumulincr, scale, movingaverage, start_date, end_date):
-    data = []
-    if cumulincr=='Cumulative':
-        covsel = covall[Cumulative]
-        plottitle = 'Cumulative Number of Deaths'
-    elif cumulincr=='Incremental':
-        covsel = covall[Incremental]
-        plottitle = 'Daily Number Deaths'
-    elif cumulincr=='Rate Per Million':
-        covsel = covall[Cumulative]
-        covsel.iloc[:,2:7] = 1000000*covsel.iloc[:,2:7].div(covsel.population, axis=0)
-        covsel = covsel.round(0)
-        plottitle = 'Number of Deaths per Million Residents'
-    elif cumulincr=='Other Rates':
-        covsel = covall[Cumulative]
-        covsel.iloc[:,2:7] = covsel.iloc[:,2:7].div(covsel.iloc[:,3], axis=0)
-        covsel = covsel.round(4)
-        plottitle = 'Number of Deaths per Positive Test'
-    
-    if scale =='Raw':
-        covsel = covsel
-    elif scale=='Log10':
-        covsel.iloc[:,2:7] = np.log10(covsel.iloc[:,2:7])      
-        
-    covsel = covsel.sort_values(by='Dateindex')
-    covsel.set_index('Dateindex', inplace=True)
-    covsel = covsel.loc[start_date:end_date]
-        
-    for state in statesel:
-        covstate = pd.DataFrame(covsel.loc[covsel['states'] == state])
-        if movingaverage =='None':
-            covstate = covstate
-        elif movingaverage == 'Moving Average 3-Day':
-            covstate.iloc[:,5] = covstate.iloc[:,5].rolling(3).mean().shift(-2)
-        elif movingaverage == 'Moving Average 7-Day':
-            covstate.iloc[:,5] = covstate.iloc[:,5].rolling(7).mean().shift(-6)
-        data.append({'x':  covstate.Date, 'y': covstate.iloc[:,5], 'type': 'line'
-                     , 'mode': 'lines+markers', 'type': 'line', 'marker': {'size': 8}, 'line': {'width' : 3}, 'name': state})
-                               
-    if scale == 'Raw':                         
-        figure = {
-                'data': data,
-                'layout': {
-                            'title': plottitle,
-                            'plot_bgcolor': '282D46',
-                            'paper_bgcolor': '282D46',
-                            'font': {
-                                'color': colors['text'],
-                                'size' : 16
-                            }
-                        }
-                }
-        return figure
-    
-    elif scale == 'Log10':                         
-        figure = {
-                'data': data,
-                'layout': {
-                            'title': plottitle,
-                            'plot_bgcolor': '282D46',
-                            'paper_bgcolor': '282D46',
-                            'font': {
-                                'color': colors['text'],
-                                'size' : 16
-                            },
-                            'yaxis': {
-                                    'tickvals': [0,1,2,3,4,5,6,7,8],
-                                    'ticktext': ['1', '10', '100', '1K', '10K', '100K', '1M', '10M', '100M']
-                                    }
-                        }
-                }
-        return figure
-
+        , dash.dependencies.Input('RankMetric', 'value')
+        , dash.dependencies.Input('RankDate', 'date')
+        , dash.dependencies.Input('DataVersion', 'data')]
+        )
+@callbacktimes.timed('update_ranking')
+def update_ranking(scope, cumulincr, scale, rankmetric, date, version):
+    metric = dict((metric['id'], metric) for metric in metrics)[rankmetric]
+    title = metric['titles'][cumulincr]
+    bars = []
+    snapshot = current_snapshot()
+    if snapshot is not None:
+        rankings = snapshot.rankings()
+        day = rankings.days()[1] if not date else day_number(date)
+        top = rankings.top(scope, cumulincr, rankmetric, day, rankshown)
+        title = '%s, %s' % (title, to_dates(day))
+        bars = [{'type': 'bar', 'orientation': 'h', 'x': [value for state, value in top]
+                 , 'y': [state for state, value in top], 'marker': {'color': '#FFD700'}}]
+    figure = graph_figure(bars, title, 'Raw')
+    figure['layout']['yaxis'] = {'autorange': 'reversed', 'automargin': True}
+    if scale == 'Log10':
+        figure['layout']['xaxis'] = {'type': 'log'}
+    return figure
+
+
+''' INSTRUMENTATION '''
+# Every request is timed, the graph requests also get the time Dash spent
+# around the callback, mostly serializing the figures. With COVID_PROFILE_DIR
+# set, requests sent with an X-Profile header are profiled.
+@server.before_request
+def start_timing():
+    flask.g.started = time.perf_counter()
+    if profiledir and 'X-Profile' in flask.request.headers:
+        flask.g.profile = start_profile()
+
+@server.after_request
+def stop_timing(response):
+    elapsed = time.perf_counter() - flask.g.started
+    if flask.request.path.endswith('_dash-update-component'):
+        route = 'graphs' if 'figure_key' in flask.g or 'figure_hit' in flask.g else 'callback'
+    else:
+        route = 'metrics' if flask.request.path == '/metrics' else 'export' if flask.request.path.startswith('/api/') else 'page'
+    if response.status_code == 503 and 'overloaded' in flask.g:
+        route = 'overloaded'
+    cache = 'hit' if 'figure_hit' in flask.g else 'miss' if 'figure_key' in flask.g else 'none'
+    requesttimes.observe(elapsed, route, cache)
+    if 'graphs_seconds' in flask.g:
+        graphtimes.observe(elapsed - flask.g.graphs_seconds, 'response')
+    if flask.g.get('profile') is not None:
+        save_profile(flask.g.profile, flask.request.path)
+    return response
+
+# Timings, figure cache and data counters of this worker in the Prometheus
+# text format
+@server.route('/metrics')
+def export_metrics():
+    lines = []
+    for histogram in histograms:
+        lines += histogram.render()
+    stats = figures.stats()
+    lines += sample('covid_figure_cache_hits_total', 'counter', 'Graph requests answered from the figure cache', stats['hits'])
+    lines += sample('covid_figure_cache_shared_hits_total', 'counter', 'Figure cache hits found in the shared store', stats['sharedhits'])
+    lines += sample('covid_figure_cache_misses_total', 'counter', 'Graph requests computed by the callback', stats['misses'])
+    lines += sample('covid_figure_cache_evictions_total', 'counter', 'Figures dropped from the worker cache', stats['evictions'])
+    lines += sample('covid_figure_cache_entries', 'gauge', 'Figures held in the worker cache', stats['entries'])
+    snapshot = data.snapshot
+    lines += sample('covid_data_loaded', 'gauge', 'Whether a data snapshot is being served', int(snapshot is not None))
+    if snapshot is not None:
+        lines += sample('covid_data_rows', 'gauge', 'Rows of the data snapshot', len(snapshot.store.days))
+        lines += sample('covid_data_age_seconds', 'gauge', 'Time since the sources were last checked', time.time() - snapshot.created)
+    stats = gate.stats()
+    lines += sample('covid_compute_slots', 'gauge', 'Requests this worker computes at once', stats['slots'])
+    lines += sample('covid_compute_running', 'gauge', 'Requests computing now', stats['running'])
+    lines += sample('covid_compute_waiting', 'gauge', 'Requests waiting for a compute slot', stats['waiting'])
+    lines += sample('covid_compute_rejected_total', 'counter', 'Requests turned away with a full queue', stats['rejected'])
+    lines += sample('covid_compute_timeouts_total', 'counter', 'Requests that waited too long for a slot', stats['timedout'])
+    return flask.Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
+
+
+''' EXPORT '''
+# Bulk export of the prepared series as CSV, JSON or Arrow. The body is
+# streamed a jurisdiction at a time from the snapshot the request started
+# with, and the ETag ties the answer to that snapshot.
+def export_snapshot():
+    snapshot = data.snapshot
+    if snapshot is None:
+        flask.abort(flask.Response(json.dumps({'error': 'data is loading'}), 503, mimetype='application/json'))
+    return snapshot
+
+def not_modified(etag):
+    response = flask.Response(status=304)
+    response.set_etag(etag)
+    return response
+
+def export_error(message):
+    return flask.Response(json.dumps({'error': message}), 400, mimetype='application/json')
+
+# /api/series?state=New York&state=Italy&metric=tests&view=Incremental
+#     &scale=Raw&average=7&start=2020-04-01&end=2020-05-01&format=csv
+@server.route('/api/series')
+def export_series():
+    snapshot = export_snapshot()
+    request = flask.request
+    try:
+        format = export_format(request.args, request.accept_mimetypes)
+        query = SeriesQuery.from_args(request.args, snapshot.store, metrics)
+    except ExportError as e:
+        return export_error(str(e))
+
+    etag = query.etag(snapshot.version, format)
+    if request.if_none_match.contains(etag):
+        return not_modified(etag)
+    # The body is computed while it is sent, a jurisdiction at a time holding
+    # a compute slot. The slot of the request is given back once the response
+    # is returned, before any of it is sent.
+    response = flask.Response(gate.each(exporters[format](snapshot, query)), content_type=exportformats[format])
+    response.set_etag(etag)
+    response.headers['Content-Disposition'] = 'inline; filename="covid19-%s.%s"' % (snapshot.version, format)
+    return response
+
+# /api/rankings?metric=death&view=Rate Per Million&scope=World&date=2020-06-01&top=10
+@server.route('/api/rankings')
+def export_rankings():
+    snapshot = export_snapshot()
+    args = flask.request.args
+    tag = etag(snapshot.version, json.dumps(sorted(args.items())))
+    if flask.request.if_none_match.contains(tag):
+        return not_modified(tag)
+    try:
+        answer = ranking(snapshot, args, metrics)
+    except ExportError as e:
+        return export_error(str(e))
+    response = flask.jsonify(answer)
+    response.set_etag(tag)
+    return response
+
+# /api/jurisdictions lists them all, ?q=york&scope=USA&limit=10 searches them
+# like the State dropdown
+@server.route('/api/jurisdictions')
+def export_jurisdictions():
+    snapshot = export_snapshot()
+    args = flask.request.args
+    states = None
+    if 'q' in args:
+        scope = args.get('scope', 'All')
+        if scope not in snapshot.all_options:
+            return export_error('scopes are %s' % ', '.join(sorted(snapshot.all_options)))
+        try:
+            limit = int(args.get('limit', searchlimit))
+        except ValueError:
+            return export_error('limit is a number of jurisdictions')
+        states = [state for state, name in search_index(snapshot).search(scope, args['q'], limit)]
+
+    tag = etag(snapshot.version, json.dumps(sorted(args.items())))
+    if flask.request.if_none_match.contains(tag):
+        return not_modified(tag)
+    response = flask.jsonify({'version': snapshot.version, 'jurisdictions': jurisdictions(snapshot, states)})
+    response.set_etag(tag)
+    return response
+
+
+''' FIGURE CACHE '''
+graphsoutput = '..' + '...'.join('%s.figure' % metric['id'] for metric in metrics) + '..'
+
+# Cache key of a graphs request: its inputs, with the DateChoice bounds as the
+# day numbers they select so equivalent date strings share an entry
+def figure_key(inputs):
+    values = dict(((i['id'], i['property']), i.get('value')) for i in inputs)
+    start_date = values.get(('DateChoice', 'start_date'))
+    end_date = values.get(('DateChoice', 'end_date'))
+    return json.dumps([values.get(('State', 'value'))
+                       , values.get(('CumulIncr', 'value'))
+                       , values.get(('Scale', 'value'))
+                       , values.get(('MovingAverage', 'value'))
+                       , None if start_date is None else day_number(start_date, ceil=True)
+                       , None if end_date is None else day_number(end_date)])
+
+# Repeated graphs requests are answered with the cached response body before
+# Dash decodes the request, misses go through the callback and are stored
+@server.before_request
+def cached_graphs():
+    request = flask.request
+    if request.method != 'POST' or not request.path.endswith('_dash-update-component'):
+        return None
+    flask.g.snapshot = snapshot = data.snapshot
+    body = request.get_json(silent=True)
+    if snapshot is None or not body or body.get('output') != graphsoutput:
+        return None
+    try:
+        key = figure_key(body.get('inputs', []))
+    except (TypeError, ValueError):
+        return None
+    cached = figures.get(key, snapshot.version)
+    if cached is not None:
+        flask.g.figure_hit = True
+        return flask.Response(cached, mimetype='application/json')
+    flask.g.figure_key = key
+
+@server.after_request
+def store_graphs(response):
+    key = flask.g.get('figure_key')
+    if key is not None and response.status_code == 200:
+        figures.put(key, flask.g.snapshot.version, response.get_data())
+    return response
+
+
+
+''' SERVING '''
+# Requests computing figures or exports go through the compute gate of the
+# worker: a few at a time, a bounded queue in front and a deadline, see
+# covserve. A burst of heavy requests is answered with quick 503s instead of
+# making every request slower, and the page, cached figures, dropdown searches
+# and health checks are never queued behind them. gunicorn.conf.py runs the
+# workers with threads so those are answered while figures compute.
+gate = ComputeGate()
+
+# Graph requests the figure cache did not answer, the series of clientside
+# mode and the series exports
+computeoutputs = [graphsoutput, 'Series.data']
+
+def computes(request):
+    if request.path == '/api/series':
+        return True
+    if request.method != 'POST' or not request.path.endswith('_dash-update-component'):
+        return False
+    body = request.get_json(silent=True)
+    return bool(body) and body.get('output') in computeoutputs
+
+@server.before_request
+def admit():
+    if computes(flask.request):
+        gate.acquire()
+        flask.g.admitted = True
+        flask.g.deadline = Deadline()
+
+@server.teardown_request
+def release(exception):
+    if flask.g.pop('admitted', False):
+        gate.release()
+
+def request_deadline():
+    if flask.has_request_context() and 'deadline' in flask.g:
+        return flask.g.deadline
+    return Deadline(0)
+
+@server.errorhandler(Overloaded)
+def overloaded(e):
+    flask.g.overloaded = True
+    response = flask.jsonify({'error': str(e)})
+    response.status_code = 503
+    response.headers['Retry-After'] = '1'
+    return response
 
 
 if __name__ == '__main__':
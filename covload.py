@@ -0,0 +1,145 @@
+import argparse
+import json
+import random
+import threading
+import time
+import numpy as np
+import pandas as pd
+import requests
+
+# Load test of a running app: threads sending heavy graph requests, several
+# jurisdictions over random date windows so the figure cache does not answer
+# them, mixed with light dropdown searches, reporting the latency of each kind.
+#
+#   gunicorn --config gunicorn.conf.py covid19:server
+#   python covload.py http://127.0.0.1:8000 --concurrency 32 --duration 30 --out gthread.json
+#   COVID_WORKER_CLASS=sync gunicorn --config gunicorn.conf.py covid19:server
+#   python covload.py http://127.0.0.1:8000 --concurrency 32 --duration 30 --out sync.json
+#
+# With sync workers the searches wait behind the graphs and their latency
+# grows with the burst. With threads and the compute gate they stay fast, and
+# graphs past the queue are answered with quick 503s.
+
+metricids = ['tests', 'positive', 'hospitalized', 'death']
+graphsoutput = '..' + '...'.join('%s.figure' % metric for metric in metricids) + '..'
+
+
+''' REQUESTS '''
+def callback_body(output, outputs, inputs, state=None):
+    return {'output': output, 'outputs': outputs, 'inputs': inputs, 'state': state or []
+            , 'changedPropIds': ['%s.%s' % (inputs[0]['id'], inputs[0]['property'])]}
+
+
+# Figures of a few jurisdictions over a random date window
+def heavy(states, rng):
+    first = pd.Timestamp('2020-01-22') + pd.Timedelta(days=int(rng.randint(0, 60)))
+    last = first + pd.Timedelta(days=int(rng.randint(30, 400)))
+    inputs = [{'id': 'State', 'property': 'value', 'value': rng.sample(states, min(len(states), 6))}
+              , {'id': 'CumulIncr', 'property': 'value', 'value': rng.choice(['Cumulative', 'Incremental'])}
+              , {'id': 'Scale', 'property': 'value', 'value': rng.choice(['Raw', 'Log10'])}
+              , {'id': 'MovingAverage', 'property': 'value'
+                 , 'value': rng.choice(['None', 'Moving Average 3-Day', 'Moving Average 7-Day'])}
+              , {'id': 'DateChoice', 'property': 'start_date', 'value': str(first.date())}
+              , {'id': 'DateChoice', 'property': 'end_date', 'value': str(last.date())}
+              , {'id': 'DataVersion', 'property': 'data', 'value': None}]
+    outputs = [{'id': metric, 'property': 'figure'} for metric in metricids]
+    return callback_body(graphsoutput, outputs, inputs)
+
+
+# Dropdown options for a couple of typed letters
+def light(states, rng):
+    typed = rng.choice(states)[:rng.randint(1, 3)]
+    inputs = [{'id': 'Scope', 'property': 'value', 'value': 'All'}
+              , {'id': 'State', 'property': 'search_value', 'value': typed}
+              , {'id': 'DataVersion', 'property': 'data', 'value': None}]
+    return callback_body('State.options', {'id': 'State', 'property': 'options'}, inputs
+                         , [{'id': 'State', 'property': 'value', 'value': []}])
+
+
+''' LOAD '''
+# Requests sent back to back by each thread until the time is up, recorded as
+# (kind, status, seconds), status 0 for a failed connection
+def load(url, states, concurrency, duration, heavyshare, timeout, seed):
+    records = []
+    lock = threading.Lock()
+    stop = time.perf_counter() + duration
+
+    def client(i):
+        rng = random.Random(seed + i)
+        session = requests.Session()
+        while time.perf_counter() < stop:
+            kind = 'heavy' if rng.random() < heavyshare else 'light'
+            body = heavy(states, rng) if kind == 'heavy' else light(states, rng)
+            start = time.perf_counter()
+            try:
+                status = session.post(url + '/_dash-update-component', json=body, timeout=timeout).status_code
+            except requests.RequestException:
+                status = 0
+            with lock:
+                records.append((kind, status, time.perf_counter() - start))
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return records
+
+
+def milliseconds(seconds):
+    return round(float(seconds)*1000, 1)
+
+
+# Status counts, latency percentiles and throughput of each kind of request
+def summary(records, duration):
+    results = {}
+    for kind in ['heavy', 'light']:
+        items = [r for r in records if r[0] == kind]
+        if not items:
+            continue
+        seconds = np.array([r[2] for r in items])
+        ok = np.array([r[2] for r in items if r[1] == 200])
+        statuses = {}
+        for r in items:
+            statuses[str(r[1])] = statuses.get(str(r[1]), 0) + 1
+        results[kind] = {'requests': len(items), 'statuses': statuses
+                         , 'per_second': round(len(ok)/duration, 2)
+                         , 'p50_ms': milliseconds(np.percentile(seconds, 50))
+                         , 'p90_ms': milliseconds(np.percentile(seconds, 90))
+                         , 'p99_ms': milliseconds(np.percentile(seconds, 99))
+                         , 'max_ms': milliseconds(seconds.max())}
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Load test of a running app')
+    parser.add_argument('url', nargs='?', default='http://127.0.0.1:8000')
+    parser.add_argument('--concurrency', type=int, default=16, help='client threads')
+    parser.add_argument('--duration', type=float, default=30, help='seconds')
+    parser.add_argument('--heavy', type=float, default=0.5, help='share of graph requests')
+    parser.add_argument('--states', help='comma separated jurisdictions, all by default')
+    parser.add_argument('--timeout', type=float, default=60, help='seconds before a request is given up')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', help='JSON results file')
+    args = parser.parse_args(argv)
+
+    url = args.url.rstrip('/')
+    if args.states:
+        states = args.states.split(',')
+    else:
+        states = [item['state'] for item in requests.get(url + '/api/jurisdictions', timeout=args.timeout).json()[
+            'jurisdictions']]
+    records = load(url, states, args.concurrency, args.duration, args.heavy, args.timeout, args.seed)
+    results = {'url': url, 'concurrency': args.concurrency, 'duration': args.duration, 'heavy': args.heavy
+               , 'summary': summary(records, args.duration)}
+    for kind, item in sorted(results['summary'].items()):
+        print('%-5s %6d requests %8.2f ok/s  p50 %8.1f  p90 %8.1f  p99 %8.1f  max %8.1f ms  %s' % (
+            kind, item['requests'], item['per_second'], item['p50_ms'], item['p90_ms'], item['p99_ms']
+            , item['max_ms'], ' '.join('%s:%d' % s for s in sorted(item['statuses'].items()))))
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.write(json.dumps(results, indent=1, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
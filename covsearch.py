@@ -0,0 +1,146 @@
+import bisect
+import collections
+import difflib
+import re
+import threading
+import unicodedata
+
+
+''' JURISDICTION SEARCH '''
+# Other names jurisdictions are found by, besides their labels, ISO codes and
+# the postal codes of the US states. Names of labels the data does not have
+# are ignored.
+aliases = {'United States': ['US', 'USA', 'America', 'United States of America']
+           , 'United Kingdom': ['UK', 'Britain', 'Great Britain']
+           , 'South Korea': ['Korea', 'Republic of Korea']
+           , 'Czech Republic': ['Czechia']
+           , 'Czechia': ['Czech Republic']
+           , 'Russia': ['Russian Federation']
+           , 'Democratic Republic of Congo': ['DRC', 'Congo Kinshasa']
+           , 'Congo': ['Congo Brazzaville']
+           , "Cote d'Ivoire": ['Ivory Coast']
+           , 'Myanmar': ['Burma']
+           , 'Eswatini': ['Swaziland']
+           , 'Swaziland': ['Eswatini']
+           , 'North Macedonia': ['Macedonia']
+           , 'Macedonia': ['North Macedonia']
+           , 'Cape Verde': ['Cabo Verde']
+           , 'Timor': ['East Timor', 'Timor Leste']
+           , 'Vatican': ['Holy See']
+           , 'United Arab Emirates': ['UAE']
+           , 'Netherlands': ['Holland']}
+
+# US state and territory names by postal code, the US labels are like 'USA, NY'
+usstates = {'AK': 'Alaska', 'AL': 'Alabama', 'AR': 'Arkansas', 'AS': 'American Samoa', 'AZ': 'Arizona'
+            , 'CA': 'California', 'CO': 'Colorado', 'CT': 'Connecticut', 'DC': 'District of Columbia'
+            , 'DE': 'Delaware', 'FL': 'Florida', 'GA': 'Georgia', 'GU': 'Guam', 'HI': 'Hawaii', 'IA': 'Iowa'
+            , 'ID': 'Idaho', 'IL': 'Illinois', 'IN': 'Indiana', 'KS': 'Kansas', 'KY': 'Kentucky'
+            , 'LA': 'Louisiana', 'MA': 'Massachusetts', 'MD': 'Maryland', 'ME': 'Maine', 'MI': 'Michigan'
+            , 'MN': 'Minnesota', 'MO': 'Missouri', 'MP': 'Northern Mariana Islands', 'MS': 'Mississippi'
+            , 'MT': 'Montana', 'NC': 'North Carolina', 'ND': 'North Dakota', 'NE': 'Nebraska'
+            , 'NH': 'New Hampshire', 'NJ': 'New Jersey', 'NM': 'New Mexico', 'NV': 'Nevada', 'NY': 'New York'
+            , 'OH': 'Ohio', 'OK': 'Oklahoma', 'OR': 'Oregon', 'PA': 'Pennsylvania', 'PR': 'Puerto Rico'
+            , 'RI': 'Rhode Island', 'SC': 'South Carolina', 'SD': 'South Dakota', 'TN': 'Tennessee'
+            , 'TX': 'Texas', 'UT': 'Utah', 'VA': 'Virginia', 'VI': 'United States Virgin Islands'
+            , 'VT': 'Vermont', 'WA': 'Washington', 'WI': 'Wisconsin', 'WV': 'West Virginia', 'WY': 'Wyoming'}
+
+# Most options sent to the dropdown at a time and option lists kept per index
+searchlimit = 50
+searchcache = 1024
+
+
+# Lower case words without accents or punctuation, what names are matched on
+def normalize(text):
+    text = unicodedata.normalize('NFKD', str(text))
+    text = ''.join(c for c in text if not unicodedata.combining(c))
+    return ' '.join(re.findall(r'[a-z0-9]+', text.lower()))
+
+
+# Names a jurisdiction is found by: its label, its ISO code, the state name
+# and postal code of the US states and the aliases
+def search_names(label, isocodes):
+    names = [label]
+    if label in isocodes:
+        names.append(isocodes[label])
+    if label.startswith('USA, '):
+        code = label[len('USA, '):]
+        names.append(code)
+        if code in usstates:
+            names.append(usstates[code])
+    return names + aliases.get(label, [])
+
+
+# Search over the jurisdictions of a snapshot. Every name is indexed from the
+# start of each of its words in one sorted list, so the names starting with
+# what was typed are found with a binary search and ranked: whole names
+# first, then name prefixes, then word prefixes. When nothing starts with it,
+# a typo, the closest names are returned. Results are cached per scope and
+# query.
+class SearchIndex(object):
+
+    def __init__(self, scopes, isocodes=None):
+        isocodes = isocodes or {}
+        self.scopes = dict((scope, list(labels)) for scope, labels in scopes.items())
+        self.allowed = dict((scope, set(labels)) for scope, labels in self.scopes.items())
+        entries = []
+        self.names = collections.defaultdict(list)
+        for label in set(label for labels in self.scopes.values() for label in labels):
+            for name in search_names(label, isocodes):
+                term = normalize(name)
+                if not term:
+                    continue
+                self.names[term].append((label, name))
+                words = term.split(' ')
+                for i in range(len(words)):
+                    entries.append((' '.join(words[i:]), i, label, name))
+        entries.sort()
+        self.keys = [entry[0] for entry in entries]
+        self.entries = entries
+        self.terms = sorted(self.names)
+        self.cache = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    # Best matches of query in a scope as (label, name matched) pairs, name is
+    # None when the label itself matched
+    def search(self, scope, query, limit=searchlimit):
+        allowed = self.allowed.get(scope, set())
+        query = normalize(query)
+        if not query:
+            return [(label, None) for label in self.scopes.get(scope, [])[:limit]]
+
+        # Best rank of each label and the name it was found by, the label
+        # itself when it matched at all
+        best = {}
+        def match(rank, label, name):
+            if label in allowed:
+                found = best.get(label, (rank, name))
+                best[label] = (min(rank, found[0]), label if label in (name, found[1]) else found[1])
+
+        i = bisect.bisect_left(self.keys, query)
+        while i < len(self.keys) and self.keys[i].startswith(query):
+            key, word, label, name = self.entries[i]
+            match(0 if key == query and not word else 1 if not word else 2, label, name)
+            i += 1
+        if not best:
+            for term in difflib.get_close_matches(query, self.terms, n=limit, cutoff=0.75):
+                for label, name in self.names[term]:
+                    match(3, label, name)
+        ranked = sorted(best.items(), key=lambda item: (item[1][0], item[0]))
+        return [(label, None if name == label else name) for label, (rank, name) in ranked[:limit]]
+
+    # Dropdown options of the matches, labels found through another name show
+    # it so the dropdown's own filtering keeps them
+    def options(self, scope, query, limit=searchlimit):
+        key = (scope, normalize(query), limit)
+        with self.lock:
+            options = self.cache.get(key)
+            if options is not None:
+                self.cache.move_to_end(key)
+                return options
+        options = [{'label': label if name is None else '%s (%s)' % (label, name), 'value': label}
+                   for label, name in self.search(scope, query, limit)]
+        with self.lock:
+            self.cache[key] = options
+            while len(self.cache) > searchcache:
+                self.cache.popitem(last=False)
+        return options
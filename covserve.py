@@ -0,0 +1,112 @@
+import logging
+import os
+import threading
+import time
+from covtiming import queuetimes
+
+log = logging.getLogger(__name__)
+
+
+''' ADMISSION CONTROL '''
+# Requests computing figures or exports at the same time in a worker, more
+# wait for a slot. Threads beyond that would only share the same CPU and the
+# GIL, making every request slower.
+computeslots = int(os.environ.get('COVID_COMPUTE_SLOTS', 2))
+
+# Requests allowed to wait for a slot and seconds they may wait. Past either,
+# the request is turned away at once with a 503 and a Retry-After, so a burst
+# does not pile up work nobody is still waiting for. Slots and queue together
+# stay below the threads of a worker, so threads are left for the requests
+# that do not compute.
+queuelimit = int(os.environ.get('COVID_QUEUE_LIMIT', 4))
+queuewait = float(os.environ.get('COVID_QUEUE_WAIT', 5))
+
+# Seconds a request may compute for once admitted, checked between
+# jurisdictions. 0 turns the deadline off.
+requesttimeout = float(os.environ.get('COVID_REQUEST_TIMEOUT', 20))
+
+
+# Request turned away or stopped to keep the latency of the others bounded,
+# answered with a 503
+class Overloaded(Exception):
+    pass
+
+
+# Bounded pool of compute slots with a bounded queue in front of it
+class ComputeGate(object):
+
+    def __init__(self, slots=computeslots, limit=queuelimit, wait=queuewait):
+        self.slots = threading.BoundedSemaphore(max(1, slots))
+        self.size = max(1, slots)
+        self.limit = limit
+        self.wait = wait
+        self.lock = threading.Lock()
+        self.waiting = 0
+        self.running = 0
+        self.rejected = 0
+        self.timedout = 0
+
+    # A slot for a new request, turned away when no slot is free and the queue
+    # is full or no slot frees up in time. Only requests that find every slot
+    # taken count as waiting. Work of a request already admitted is not
+    # queued: it waits for a slot as long as it takes.
+    def acquire(self, queued=True):
+        start = time.perf_counter()
+        if not self.slots.acquire(blocking=False):
+            with self.lock:
+                if queued and self.waiting >= self.limit:
+                    self.rejected += 1
+                    queuetimes.observe(0., 'rejected')
+                    raise Overloaded('too many requests waiting')
+                self.waiting += 1
+            try:
+                acquired = self.slots.acquire(timeout=self.wait if queued else None)
+            finally:
+                with self.lock:
+                    self.waiting -= 1
+            if not acquired:
+                with self.lock:
+                    self.timedout += 1
+                queuetimes.observe(time.perf_counter() - start, 'timeout')
+                raise Overloaded('no compute slot within %g seconds' % self.wait)
+        with self.lock:
+            self.running += 1
+        queuetimes.observe(time.perf_counter() - start, 'admitted')
+
+    def release(self):
+        with self.lock:
+            self.running -= 1
+        self.slots.release()
+
+    # Items of an iterator computed one at a time holding a slot, which is
+    # given back while each item is sent, so a slow client downloading a large
+    # answer does not keep the slot
+    def each(self, items):
+        items = iter(items)
+        while True:
+            self.acquire(queued=False)
+            try:
+                item = next(items, None)
+            finally:
+                self.release()
+            if item is None:
+                return
+            yield item
+
+    def stats(self):
+        with self.lock:
+            return {'slots': self.size, 'running': self.running, 'waiting': self.waiting
+                    , 'rejected': self.rejected, 'timedout': self.timedout}
+
+
+# Time left to a request, Overloaded once it is spent
+class Deadline(object):
+
+    def __init__(self, seconds=requesttimeout):
+        self.seconds = seconds
+        self.expires = time.perf_counter() + seconds if seconds else None
+
+    def check(self):
+        if self.expires is not None and time.perf_counter() > self.expires:
+            log.warning('Stopped a request still computing after %g seconds', self.seconds)
+            raise Overloaded('request took longer than %g seconds' % self.seconds)
@@ -0,0 +1,173 @@
+import concurrent.futures
+import json
+import logging
+import os
+import tempfile
+import time
+import requests
+
+log = logging.getLogger(__name__)
+
+
+''' SOURCES '''
+# Where the data comes from: https://covid.ourworldindata.org/ for the world,
+# https://covidtracking.com/ for the US and its states and the population
+# files shipped with the app
+here = os.path.dirname(os.path.abspath(__file__))
+sourcelocations = {'world': 'https://covid.ourworldindata.org/data/owid-covid-data.csv'
+                   , 'us': 'https://covidtracking.com/api/v1/us/daily.csv'
+                   , 'states': 'https://covidtracking.com/api/v1/states/daily.csv'
+                   , 'uspop': os.path.join(here, 'uspopulation.csv')
+                   , 'worldpop': os.path.join(here, 'worldpopulation.csv')}
+
+# File names of the sources in a COVID_SOURCE_DIR directory
+sourcefiles = {'world': 'owid-covid-data.csv', 'us': 'us-daily.csv', 'states': 'states-daily.csv'
+               , 'uspop': 'uspopulation.csv', 'worldpop': 'worldpopulation.csv'}
+
+# Seconds to wait on a server and attempts per download
+sourcetimeout = int(os.environ.get('COVID_SOURCE_TIMEOUT', 60))
+sourceretries = int(os.environ.get('COVID_SOURCE_RETRIES', 3))
+
+# What fetch returns in place of changed when the server could not be reached
+# and the copy kept from an earlier fetch is used instead
+stalecopy = 'stale'
+
+
+# Source read from a local file, a fixture or a file shipped with the app.
+# The file counts as changed when its size or modification time did.
+class FileSource(object):
+
+    def __init__(self, name, path):
+        self.name = name
+        self.location = path
+        self.stat = None
+
+    # Local path of the current content and whether it may have changed
+    def fetch(self):
+        stat = os.stat(self.location)
+        stat = (stat.st_size, stat.st_mtime)
+        changed = stat != self.stat
+        self.stat = stat
+        return self.location, changed
+
+
+# Source downloaded over HTTP into folder on every fetch. Failed attempts
+# are retried with a growing pause, client errors are not.
+class HttpSource(object):
+
+    def __init__(self, name, url, folder, timeout=sourcetimeout, retries=sourceretries):
+        self.name = name
+        self.location = url
+        self.folder = folder
+        self.timeout = timeout
+        self.retries = retries
+
+    def path(self):
+        return os.path.join(self.folder, '%s.csv' % self.name)
+
+    def get(self, headers=None):
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                response = requests.get(self.location, headers=headers, stream=True, timeout=self.timeout)
+                response.raise_for_status()
+                return response
+            except requests.RequestException as e:
+                response = getattr(e, 'response', None)
+                if (response is not None and response.status_code < 500) or attempt >= self.retries:
+                    raise
+                log.warning('Fetching %s failed, retrying: %s', self.location, e)
+                time.sleep(2**(attempt - 1))
+
+    # Streams the body to a temporary file renamed over the previous copy, a
+    # failed download leaves the previous copy in place
+    def save(self, response):
+        if not os.path.isdir(self.folder):
+            os.makedirs(self.folder)
+        tmp = '%s.tmp%d' % (self.path(), os.getpid())
+        with response, open(tmp, 'wb') as f:
+            response.raw.decode_content = True
+            for block in iter(lambda: response.raw.read(1 << 20), b''):
+                f.write(block)
+        os.replace(tmp, self.path())
+        return self.path()
+
+    def fetch(self):
+        return self.save(self.get()), True
+
+
+# HttpSource keeping its copy between fetches with the ETag and Last-Modified
+# of the response, sent back as If-None-Match and If-Modified-Since so an
+# unchanged source is not downloaded again. The last copy is used when the
+# server can not be reached, reported as stalecopy rather than unchanged.
+class CachedSource(HttpSource):
+
+    def validators(self):
+        try:
+            with open(self.path() + '.json') as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def fetch(self):
+        cached = os.path.isfile(self.path())
+        validators = self.validators() if cached else {}
+        headers = {}
+        if validators.get('etag'):
+            headers['If-None-Match'] = validators['etag']
+        if validators.get('last_modified'):
+            headers['If-Modified-Since'] = validators['last_modified']
+        try:
+            response = self.get(headers)
+        except requests.RequestException:
+            if not cached:
+                raise
+            log.exception('Could not fetch %s, using the copy in %s', self.location, self.folder)
+            return self.path(), stalecopy
+        if response.status_code == 304:
+            response.close()
+            return self.path(), False
+
+        path = self.save(response)
+        with open(path + '.json', 'w') as f:
+            json.dump({'etag': response.headers.get('ETag'), 'last_modified': response.headers.get('Last-Modified')
+                       , 'fetched': time.time()}, f)
+        return path, True
+
+
+# Source for a URL or a path. URLs are cached in folder when there is one,
+# downloaded to a temporary directory otherwise.
+def make_source(name, location, folder=None):
+    if not location.startswith(('http://', 'https://')):
+        return FileSource(name, location)
+    if folder:
+        return CachedSource(name, location, folder)
+    return HttpSource(name, location, tempfile.mkdtemp(prefix='covid-sources'))
+
+
+# Sources from the environment: COVID_SOURCE_DIR reads them all from files in
+# a directory, COVID_SOURCE_<NAME> points one of them at another URL or path
+# and COVID_SOURCE_CACHE is where the remote ones are kept between fetches.
+def default_sources(cache=None):
+    folder = os.environ.get('COVID_SOURCE_DIR', '')
+    cache = os.environ.get('COVID_SOURCE_CACHE', cache or '')
+    sources = {}
+    for name, location in sourcelocations.items():
+        if folder:
+            location = os.path.join(folder, sourcefiles[name])
+        location = os.environ.get('COVID_SOURCE_%s' % name.upper(), location)
+        sources[name] = make_source(name, location, cache)
+    return sources
+
+
+# Fetches the sources at the same time, so the wait is the one of the slowest.
+# Returns the local path of each, whether any of them changed and the names of
+# those only available as a stale copy.
+def fetch_sources(sources):
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, len(sources))) as pool:
+        futures = dict((name, pool.submit(source.fetch)) for name, source in sources.items())
+        results = dict((name, future.result()) for name, future in futures.items())
+    paths = dict((name, path) for name, (path, changed) in results.items())
+    stale = sorted(name for name, (path, changed) in results.items() if changed == stalecopy)
+    return paths, any(changed is True for path, changed in results.values()), stale
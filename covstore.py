@@ -0,0 +1,398 @@
+import numpy as np
+import pandas as pd
+
+
+''' SERIES STORE '''
+# Dates are kept as int32 day numbers counted from 1970-01-01, the integer
+# behind numpy's datetime64[D]
+def to_days(dates):
+    return np.asarray(dates, dtype='datetime64[ns]').astype('datetime64[D]').astype(np.int32)
+
+
+def to_dates(days):
+    return np.asarray(days).astype('datetime64[D]')
+
+
+# Day number of a DateChoice bound. A start later than midnight begins on the
+# next day, like .loc slicing did on the midnight dates. An empty date raises
+# ValueError like a malformed one.
+def day_number(date, ceil=False):
+    stamp = pd.Timestamp(date)
+    if pd.isnull(stamp):
+        raise ValueError('%r is not a date' % (date,))
+    day = int(np.datetime64(stamp, 'D').astype(np.int64))
+    if ceil and stamp != stamp.normalize():
+        day += 1
+    return day
+
+
+# Jurisdiction keyed store of the prepared data. The combined frame is sorted
+# once by jurisdiction and date and every column is kept as one contiguous
+# numpy array, so a jurisdiction is just a (start, stop) slice of those arrays
+# and the graph callbacks only touch the rows they plot. The arrays are read
+# only, they may be memory mapped from a snapshot on disk.
+#
+# Jurisdictions are integer codes: labels[code] is the name and rows
+# starts[code]:stops[code] hold its dates in days and its columns.
+class SeriesStore(object):
+
+    def __init__(self, labels, starts, stops, days, columns):
+        self.labels = labels
+        self.starts = starts
+        self.stops = stops
+        self.days = days
+        self.columns = columns
+        self.index = dict((label, code) for code, label in enumerate(labels))
+
+    @classmethod
+    def from_frame(cls, frame, columns, key='states', day='day'):
+        frame = frame.sort_values(by=[key, day], kind='mergesort')
+        keys = np.asarray(frame[key])
+
+        days = np.array(frame[day].values, dtype=np.int32)
+        values = {}
+        for c in columns:
+            values[c] = np.array(frame[c].values, dtype=float)
+
+        # Row offsets of each jurisdiction, keys are contiguous after the sort
+        if len(keys):
+            bounds = np.flatnonzero(keys[1:] != keys[:-1]) + 1
+            starts = np.concatenate([[0], bounds]).astype(np.int64)
+            stops = np.concatenate([bounds, [len(keys)]]).astype(np.int64)
+        else:
+            starts = stops = np.zeros(0, dtype=np.int64)
+        labels = [str(k) for k in keys[starts]]
+
+        for array in [starts, stops, days] + list(values.values()):
+            array.flags.writeable = False
+        return cls(labels, starts, stops, days, values)
+
+    def __contains__(self, state):
+        return state in self.index
+
+    def __len__(self):
+        return len(self.labels)
+
+    def keys(self):
+        return list(self.labels)
+
+    def dates(self, rows):
+        return to_dates(self.days[rows])
+
+    # Rows of a jurisdiction within the DateChoice range, both ends included, as
+    # a slice of the store arrays. The days of a jurisdiction are sorted, so
+    # the range is two binary searches whatever the length of its history.
+    # Unknown jurisdictions select no rows like the old covall filter did.
+    def rows(self, state, start_date=None, end_date=None):
+        code = self.index.get(state)
+        if code is None:
+            return slice(0, 0)
+
+        start, stop = int(self.starts[code]), int(self.stops[code])
+        days = self.days[start:stop]
+        first, last = 0, len(days)
+        if start_date is not None:
+            first = int(np.searchsorted(days, day_number(start_date, ceil=True), side='left'))
+        if end_date is not None:
+            last = int(np.searchsorted(days, day_number(end_date), side='right'))
+        return slice(start + first, start + max(first, last))
+
+    # Store with new rows appended at the end of their jurisdictions. codes
+    # are sorted, with the days ascending within a code and after the last
+    # stored day. Returns the store and the positions the rows went in at,
+    # for np.insert on any array aligned with the old rows.
+    def extend(self, codes, days, columns):
+        at = self.stops[codes]
+        added = np.bincount(codes, minlength=len(self.labels))
+        stops = self.stops + np.cumsum(added)
+        starts = stops - added - (self.stops - self.starts)
+        days = np.insert(np.asarray(self.days), at, days).astype(np.int32)
+        values = {}
+        for c in self.columns:
+            values[c] = np.insert(np.asarray(self.columns[c]), at, columns[c]).astype(float)
+
+        for array in [starts, stops, days] + list(values.values()):
+            array.flags.writeable = False
+        return SeriesStore(list(self.labels), starts, stops, days, values), at
+
+
+''' VIEW CACHE '''
+VIEWS = ['Cumulative', 'Incremental', 'Rate Per Million', 'Other Rates']
+SCALES = ['Raw', 'Log10']
+
+
+# Values of one metric for a CumulIncr view, over every jurisdiction at once.
+# A metric names its cumulative and daily columns, the column its Other Rates
+# view is divided by and optionally a cap above which those rates are zeroed.
+def view_values(columns, metric, view):
+    if view == 'Cumulative':
+        return columns[metric['cumulative']]
+    elif view == 'Incremental':
+        return columns[metric['incremental']]
+    elif view == 'Rate Per Million':
+        return (1000000*(columns[metric['cumulative']]/columns['population'])).round(0)
+    elif view == 'Other Rates':
+        values = (columns[metric['cumulative']]/columns[metric['per']]).round(4)
+        if 'cap' in metric:
+            values[values > metric['cap']] = 0
+        return values
+
+
+# Values of every view of every metric, each row on its own
+def compute_views(columns, metrics):
+    views = {}
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for view in VIEWS:
+            raw = {}
+            log = {}
+            for metric in metrics:
+                name = metric['id']
+                raw[name] = np.array(view_values(columns, metric, view))
+                log[name] = np.log10(raw[name])
+            views[view, 'Raw'] = raw
+            views[view, 'Log10'] = log
+    return views
+
+
+''' SMOOTHING '''
+# Running sums behind the moving averages of a cached view, built in one
+# grouped pass over all jurisdictions. sums is the cumulative sum of the
+# finite values and bad the count of non finite values, both restarting at
+# every jurisdiction, so rows appended to a jurisdiction leave the others alone.
+def running_sums(values, starts, stops):
+    codes = np.repeat(np.arange(len(starts)), stops - starts)
+    return grouped_sums(values, codes)
+
+
+# Running sums over rows grouped by sorted codes. For rows appended to a
+# jurisdiction, lastsums and lastbad hold the sums of its last stored row for
+# each of them, the sums carry on from there exactly as in one pass.
+def grouped_sums(values, codes, lastsums=None, lastbad=None):
+    finite = np.isfinite(values)
+    clean = np.where(finite, values, 0.)
+    counts = (~finite).astype(np.int32)
+    if lastsums is not None and len(codes):
+        # Start each group at its stored sums, then drop those seed rows
+        first = np.flatnonzero(np.concatenate([[True], codes[1:] != codes[:-1]]))
+        clean = np.insert(clean, first, lastsums[first])
+        counts = np.insert(counts, first, lastbad[first])
+        codes = np.insert(codes, first, codes[first])
+        keep = np.ones(len(codes), dtype=bool)
+        keep[first + np.arange(len(first))] = False
+    else:
+        keep = slice(None)
+    sums = pd.Series(clean).groupby(codes).cumsum().values[keep]
+    bad = pd.Series(counts).groupby(codes).cumsum().values[keep].astype(np.int32)
+    return sums, bad
+
+
+# Forward looking n row moving average of the rows start:stop of one
+# jurisdiction from its running sums, for any n in time proportional to the
+# rows. Same as rolling(n).mean().shift(-(n-1)) on those rows: windows that
+# run past stop or hold a non finite value are NaN. The rows are contiguous,
+# the window ends are slices of the sums and the average is computed in place
+# in out, a new array when not given.
+def window_average(values, sums, bad, start, stop, n, out=None):
+    if out is None:
+        out = np.empty(stop - start)
+    out.fill(np.nan)
+    count = stop - start - n + 1
+    if count <= 0:
+        return out
+    average = out[:count]
+    np.subtract(sums[start + n - 1:stop], sums[start:start + count], out=average)
+    first = values[start:start + count]
+    finite = np.isfinite(first)
+    np.add(average, first, out=average, where=finite)
+    average /= n
+    broken = bad[start + n - 1:stop] - bad[start:start + count]
+    broken += ~finite
+    average[broken != 0] = np.nan
+    return out
+
+
+# Every (CumulIncr, Scale) combination of every metric, computed once per data
+# load and aligned with the store rows, so the callbacks only index into it,
+# with the running sums their moving averages are taken from
+class ViewCache(object):
+
+    def __init__(self, views, sums, bad):
+        self.views = views
+        self.sums = sums
+        self.bad = bad
+
+    @classmethod
+    def from_store(cls, store, metrics):
+        views = compute_views(store.columns, metrics)
+        sums = {}
+        bad = {}
+        for key, cached in views.items():
+            sums[key] = {}
+            bad[key] = {}
+            for name, values in cached.items():
+                sums[key][name], bad[key][name] = running_sums(values, store.starts, store.stops)
+                for array in [values, sums[key][name], bad[key][name]]:
+                    array.flags.writeable = False
+        return cls(views, sums, bad)
+
+    # Views of a store extended with SeriesStore.extend: only the new rows are
+    # computed, their running sums carry on from the last stored rows
+    def extend(self, store, at, codes, columns, metrics):
+        added = compute_views(columns, metrics)
+        lastrows = store.stops[codes] - 1
+        views = {}
+        sums = {}
+        bad = {}
+        for key, cached in added.items():
+            views[key] = {}
+            sums[key] = {}
+            bad[key] = {}
+            for name, values in cached.items():
+                oldsums = np.asarray(self.sums[key][name])
+                oldbad = np.asarray(self.bad[key][name])
+                newsums, newbad = grouped_sums(values, codes, oldsums[lastrows], oldbad[lastrows])
+                views[key][name] = np.insert(np.asarray(self.views[key][name]), at, values)
+                sums[key][name] = np.insert(oldsums, at, newsums)
+                bad[key][name] = np.insert(oldbad, at, newbad)
+                for array in [views[key][name], sums[key][name], bad[key][name]]:
+                    array.flags.writeable = False
+        return ViewCache(views, sums, bad)
+
+    # Moving average of a metric over the rows slice of one jurisdiction
+    def average(self, key, name, rows, n, out=None):
+        return window_average(self.views[key][name], self.sums[key][name], self.bad[key][name]
+                              , rows.start, rows.stop, n, out)
+
+    # Values of several metrics over the rows slice of one jurisdiction, one
+    # column each, averaged over n rows when n is given. They are written
+    # straight into a single buffer the size of the answer, column major so
+    # every column is contiguous.
+    def select(self, key, names, rows, n=None):
+        out = np.empty((rows.stop - rows.start, len(names)), order='F')
+        for i, name in enumerate(names):
+            if n:
+                self.average(key, name, rows, n, out[:, i])
+            else:
+                out[:, i] = self.views[key][name][rows]
+        return out
+
+
+''' RANKINGS '''
+# Top jurisdictions of every date for each CumulIncr view and metric within
+# each scope, highest value first. The store rows of a view are spread into a
+# dates by jurisdictions matrix, np.partition finds the top of every date at
+# once and only those are sorted, so asking for the top of a date is an
+# index into the arrays whatever the number of jurisdictions. Jurisdictions
+# without a finite value on a date are not ranked on it, codes of -1 fill the
+# dates with fewer of them than top.
+class Rankings(object):
+
+    def __init__(self, labels, first, codes, values, size):
+        self.labels = labels
+        self.first = first
+        self.codes = codes
+        self.values = values
+        self.size = size
+
+    @classmethod
+    def from_store(cls, store, views, scopes, top):
+        labels = list(store.labels)
+        days = np.asarray(store.days)
+        if not len(days):
+            return cls(labels, 0, {}, {}, top)
+        first = int(days.min())
+        dates = days - first
+        jurisdictions = np.repeat(np.arange(len(labels)), np.asarray(store.stops) - np.asarray(store.starts))
+        columns = dict((scope, np.array(sorted(store.index[label] for label in options if label in store.index)
+                                        , dtype=np.int64)) for scope, options in scopes.items())
+        codes = {}
+        values = {}
+        for (view, scale), cached in views.views.items():
+            if scale != 'Raw':
+                continue
+            for name, series in cached.items():
+                series = np.asarray(series)
+                finite = np.isfinite(series)
+                matrix = np.full((int(dates.max()) + 1, len(labels)), -np.inf)
+                matrix[dates[finite], jurisdictions[finite]] = series[finite]
+                for scope, scopecolumns in columns.items():
+                    k = min(top, len(scopecolumns))
+                    sub = matrix[:, scopecolumns]
+                    if k < len(scopecolumns):
+                        # The k-th highest value of each date, then what is above
+                        # it and as many of the jurisdictions equal to it as fit
+                        # in label order, so ties at the cut are always resolved
+                        # the same way
+                        kth = -np.partition(-sub, k - 1, axis=1)[:, k - 1:k]
+                        above = sub > kth
+                        equal = sub == kth
+                        chosen = above | (equal & (np.cumsum(equal, axis=1) <= k - above.sum(axis=1, keepdims=True)))
+                        picked = np.nonzero(chosen)[1].reshape(len(sub), k)
+                    else:
+                        picked = np.tile(np.arange(len(scopecolumns)), (len(sub), 1))
+                    top_values = np.take_along_axis(sub, picked, axis=1)
+                    # Highest first, ties in label order
+                    order = np.lexsort((picked, -top_values), axis=1)
+                    picked = np.take_along_axis(picked, order, axis=1)
+                    top_values = np.take_along_axis(top_values, order, axis=1)
+                    ranked = scopecolumns[picked].astype(np.int32)
+                    ranked[~np.isfinite(top_values)] = -1
+                    top_values[ranked < 0] = np.nan
+                    for array in [ranked, top_values]:
+                        array.flags.writeable = False
+                    codes[scope, view, name] = ranked
+                    values[scope, view, name] = top_values
+        return cls(labels, first, codes, values, top)
+
+    # Days ranked, from the first to the last day of the store
+    def days(self):
+        count = len(next(iter(self.codes.values()))) if self.codes else 0
+        return self.first, self.first + count - 1
+
+    # (label, value) of the n first jurisdictions of scope on a day number
+    def top(self, scope, view, name, day, n):
+        codes = self.codes.get((scope, view, name))
+        i = day - self.first
+        if codes is None or i < 0 or i >= len(codes):
+            return []
+        return [(self.labels[code], float(value)) for code, value
+                in zip(codes[i, :n].tolist(), self.values[scope, view, name][i, :n].tolist()) if code >= 0]
+
+
+''' DOWNSAMPLING '''
+# Positions of the points of a series worth drawing when only about points of
+# them fit across a graph. The rows are cut in buckets of consecutive days that
+# keep their first, last, lowest and highest points, so the line drawn through
+# them covers the same pixels. Both ends of every run of non finite values are
+# kept with their neighbours, so the line breaks at the same places.
+def plot_points(values, points):
+    n = len(values)
+    if not points or n <= points:
+        return np.arange(n)
+
+    size = -(-4*n // points)
+    count = -(-n // size)
+    finite = np.isfinite(values)
+    low = np.full(count*size, np.inf)
+    low[:n] = np.where(finite, values, np.inf)
+    high = np.full(count*size, -np.inf)
+    high[:n] = np.where(finite, values, -np.inf)
+    starts = np.arange(count)*size
+    edges = np.flatnonzero(finite[1:] != finite[:-1])
+    return np.unique(np.concatenate([starts, np.minimum(starts + size, n) - 1
+                                     , starts + low.reshape(count, size).argmin(axis=1)
+                                     , starts + high.reshape(count, size).argmax(axis=1)
+                                     , edges, edges + 1]))
+
+
+# Values rounded to digits significant digits for sending, whole numbers and
+# non finite values are left as they are
+def plot_values(values, digits):
+    if not digits:
+        return values
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        exponent = digits - 1 - np.floor(np.log10(np.abs(values)))
+        scale = 10.0**np.abs(exponent)
+        rounded = np.where(exponent >= 0, np.round(values*scale)/scale, np.round(values/scale)*scale)
+    keep = (values == np.round(values)) | ~np.isfinite(rounded)
+    return np.where(keep, values, rounded)
@@ -0,0 +1,140 @@
+import bisect
+import collections
+import contextlib
+import cProfile
+import functools
+import logging
+import os
+import re
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+
+''' TIMINGS '''
+# Upper bounds in seconds of the histogram buckets
+timingbuckets = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120]
+
+# Latency histogram in the Prometheus text format, one series per set of
+# label values. Histograms are kept per worker process, each worker answers
+# the metrics endpoint with its own.
+class Histogram(object):
+
+    def __init__(self, name, description, labels, buckets=timingbuckets):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.buckets = buckets
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, seconds, *values):
+        i = bisect.bisect_left(self.buckets, seconds)
+        with self.lock:
+            series = self.series.get(values)
+            if series is None:
+                series = self.series[values] = [[0]*(len(self.buckets) + 1), 0., 0]
+            series[0][i] += 1
+            series[1] += seconds
+            series[2] += 1
+
+    @contextlib.contextmanager
+    def time(self, *values):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *values)
+
+    # Decorator timing every call of a function
+    def timed(self, *values):
+        def decorator(f):
+            @functools.wraps(f)
+            def wrapper(*args, **kwargs):
+                with self.time(*values):
+                    return f(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.description), '# TYPE %s histogram' % self.name]
+        with self.lock:
+            series = sorted((values, (list(counts), total, count)) for values, (counts, total, count) in self.series.items())
+        for values, (counts, total, count) in series:
+            labels = ['%s="%s"' % (k, escape(v)) for k, v in zip(self.labels, values)]
+            cumulative = 0
+            for bound, n in zip(['%g' % b for b in self.buckets] + ['+Inf'], counts):
+                cumulative += n
+                lines.append('%s_bucket{%s} %d' % (self.name, ','.join(labels + ['le="%s"' % bound]), cumulative))
+            lines.append('%s_sum%s %r' % (self.name, braces(labels), total))
+            lines.append('%s_count%s %d' % (self.name, braces(labels), count))
+        return lines
+
+
+# Times the stages of one call, each stage observed once with its total
+class Stages(object):
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+        self.totals = collections.OrderedDict()
+
+    @contextlib.contextmanager
+    def time(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.totals[stage] = self.totals.get(stage, 0.) + time.perf_counter() - start
+
+    def observe(self):
+        for stage, total in self.totals.items():
+            self.histogram.observe(total, stage)
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def braces(labels):
+    return '{%s}' % ','.join(labels) if labels else ''
+
+
+# A single counter or gauge sample
+def sample(name, kind, description, value):
+    return ['# HELP %s %s' % (name, description), '# TYPE %s %s' % (name, kind), '%s %r' % (name, value)]
+
+
+callbacktimes = Histogram('covid_callback_seconds', 'Time spent in the Dash callbacks', ['callback'])
+graphtimes = Histogram('covid_graph_stage_seconds', 'Time spent in each stage of the graphs callback', ['stage'])
+etltimes = Histogram('covid_etl_stage_seconds', 'Time spent in each step of a data load', ['stage'])
+requesttimes = Histogram('covid_request_seconds', 'Time to answer the HTTP requests', ['route', 'cache'])
+queuetimes = Histogram('covid_queue_wait_seconds', 'Time requests waited for a compute slot', ['outcome'])
+
+histograms = [callbacktimes, graphtimes, etltimes, requesttimes, queuetimes]
+
+
+''' PROFILING '''
+# Directory the request profiles are written to. Empty, the default, turns
+# profiling off; when set, requests sent with an X-Profile header run under
+# cProfile and leave a .prof file there for pstats or snakeviz.
+profiledir = os.environ.get('COVID_PROFILE_DIR', '')
+
+def start_profile():
+    profile = cProfile.Profile()
+    try:
+        profile.enable()
+    except ValueError:
+        # Another request of this process is being profiled
+        return None
+    return profile
+
+
+def save_profile(profile, path):
+    profile.disable()
+    if not os.path.isdir(profiledir):
+        os.makedirs(profiledir)
+    filename = os.path.join(profiledir, '%d-%d-%s.prof' % (time.time()*1000, os.getpid()
+                                                          , re.sub(r'[^A-Za-z0-9]+', '-', path).strip('-') or 'index'))
+    profile.dump_stats(filename)
+    log.info('Wrote request profile %s', filename)
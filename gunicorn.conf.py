@@ -0,0 +1,16 @@
+import os
+
+# Threaded workers: the page, cached figures, dropdown searches and health
+# checks are answered by the free threads of a worker while other threads
+# compute figures, and the compute gate of covserve bounds how many of those
+# run at once. COVID_WORKER_CLASS=sync serves one request at a time per
+# worker as before.
+worker_class = os.environ.get('COVID_WORKER_CLASS', 'gthread')
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+threads = int(os.environ.get('COVID_THREADS', 8))
+
+# Seconds before a stuck worker is restarted, longer than the request
+# deadline and the queue wait together
+timeout = int(os.environ.get('COVID_WORKER_TIMEOUT', 60))
+graceful_timeout = 30
+keepalive = 5
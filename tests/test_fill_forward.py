@@ -0,0 +1,49 @@
+import numpy as np
+import pandas as pd
+from pandas.testing import assert_frame_equal
+from covdata import fill_forward
+
+
+# The per country loop fill_forward replaced, kept as the reference
+def loop_fill(world):
+    world = world.copy()
+    countryall = world['states'].unique()
+    for w in countryall:
+        country = world.loc[world['states']==w]
+        country = country.fillna(method='ffill')
+        world.loc[world['states']==w] = country
+    return world
+
+
+# World data sorted by country and date like in load_world, with blanks at
+# the start, in the middle and at the end of the countries
+def world_fixture():
+    nan = np.nan
+    states = ['Albania']*5 + ['Brazil']*4 + ['Chad']*3 + ['Denmark']*4
+    dates = (list(pd.date_range('2020-03-01', periods=5)) + list(pd.date_range('2020-03-02', periods=4))
+             + list(pd.date_range('2020-03-01', periods=3)) + list(pd.date_range('2020-03-03', periods=4)))
+    return pd.DataFrame({'iso_code': pd.Categorical(['ALB']*5 + ['BRA']*4 + ['TCD']*3 + ['DNK']*4)
+                         , 'states': pd.Categorical(states)
+                         , 'dateChecked': dates
+                         , 'positive': [nan, 1, nan, nan, 4, 2, nan, 5, nan, nan, nan, nan, 7, 8, nan, nan]
+                         , 'death': [0, nan, nan, 1, nan, nan, nan, 1, 2, 3, nan, 4, nan, nan, 1, 2]
+                         , 'total': [nan, nan, 10, nan, 30, 5, 6, nan, nan, nan, nan, nan, 100, nan, nan, 130]
+                         , 'positiveMil': np.array([nan, .5, nan, 1, nan, 1, nan, nan, 2, nan, nan, .1
+                                                    , nan, 3, nan, nan], dtype='float32')
+                         , 'testunits': pd.Categorical([None, 'tests performed', None, None, None, 'people tested'
+                                                        , None, None, None, None, None, None, None, None
+                                                        , 'tests performed', None])})
+
+
+def test_fill_forward_matches_loop():
+    world = world_fixture()
+    expected = loop_fill(world)
+    assert_frame_equal(fill_forward(world.copy()), expected)
+
+
+def test_fill_forward_does_not_fill_across_countries():
+    world = fill_forward(world_fixture())
+    chad = world[world['states'] == 'Chad']
+    assert chad['positive'].isnull().all()
+    assert chad['total'].isnull().all()
+    assert world.loc[world['states'] == 'Denmark', 'positive'].iloc[0] == 7
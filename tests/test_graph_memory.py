@@ -0,0 +1,50 @@
+import os
+import tracemalloc
+import pytest
+import covbench
+import covdata
+import covid19
+from covsource import sourcefiles
+
+# Peak memory of a graph callback over the size of the values it returns. The
+# values go into one buffer of the selected rows, what is left of the peak is
+# the trace lists sent to the browser. A temporary the size of a whole column
+# of the store, about 45000 rows here, is well past it.
+peakratio = 32
+
+
+# Snapshot of synthetic data with many more rows than the graphs select
+@pytest.fixture(scope='module')
+def snapshot(tmp_path_factory):
+    folder = str(tmp_path_factory.mktemp('sources'))
+    covbench.generate(folder, countries=150, states=30, days=300)
+    paths = dict((name, os.path.join(folder, filename)) for name, filename in sourcefiles.items())
+    covall, all_options, isocodes = covdata.prepare(paths)
+    snapshot = covdata.build_snapshot(covall, all_options, covid19.metrics, isocodes)
+    previous = covid19.data.snapshot
+    covid19.data.snapshot = snapshot
+    yield snapshot
+    covid19.data.snapshot = previous
+
+
+# Peak memory allocated by update_graphs and the number of values it returned
+def graphs_peak(args):
+    update_graphs = covid19.update_graphs.__wrapped__
+    update_graphs(*args)
+    tracemalloc.start()
+    try:
+        graphs = update_graphs(*args)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return peak, sum(len(trace['y']) for graph in graphs for trace in graph['data'])
+
+
+@pytest.mark.parametrize('cumulincr, scale, movingaverage', [('Cumulative', 'Raw', 'None')
+                                                             , ('Rate Per Million', 'Log10', 'Moving Average 7-Day')
+                                                             , ('Incremental', 'Raw', 'Moving Average 14-Day')])
+def test_update_graphs_peak_memory(snapshot, cumulincr, scale, movingaverage):
+    states = list(snapshot.store.keys())[:3]
+    peak, values = graphs_peak((states, cumulincr, scale, movingaverage, '2020-06-01', '2020-07-31', None))
+    assert values > 0
+    assert peak <= peakratio*values*8, 'peak %d bytes for %d values' % (peak, values)